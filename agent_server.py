@@ -1,15 +1,49 @@
 # create a fastapi server and expose a ask_agent function
 # that takes a question and returns an answer
+import time
+
+# the boot is timed from here
+_import_started = time.perf_counter()
+
+import asyncio
+import contextvars
+import functools
 import json
-from fastapi import FastAPI
+import os
+import uuid
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import Dict, List
-import requests
-from julep import Client
-from functions.start import start_game, get_hint, verify
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Set, Tuple
+from functions.geo import parse_lat_lng
+from functions.events import event_log
+from functions.http import get_transport
+from functions.intents import route, stats as intent_stats
+from functions.llm import get_completion_cache, get_openai_client
+from functions.maps import get_cache, get_maps_client
+from functions.metrics import SIZE_BUCKETS, count, observe, record_request, registry, request_counts, span
+from functions.progress import listen, report
+from functions.scheduler import scheduler
+from functions.start import (
+    NO_GAME_MESSAGE, NO_LOCATION_MESSAGE, NO_PLACES_MESSAGE, check_answer, get_hint, has_active_game,
+    reached_targets, start_game, verify, warm_pool,
+)
+from functions.state import get_state_backend
+from functions.tiles import get_tile_packs
 import logging
 import sys
 
+if TYPE_CHECKING:
+    from julep import AsyncClient
+
+# the julep and OpenAI SDKs are slow to import, so they are only imported
+# when their clients are built during the warm-up
+IMPORT_SECONDS = time.perf_counter() - _import_started
+
 
 def get_logger():
     # Create a StreamHandler to log messages to the console
@@ -24,8 +58,6 @@ def get_logger():
 logger = get_logger()
 
 
-app = FastAPI()
-
 
 INSTRUCTIONS = [
     "You are a game master and must help conduct a game for the user."
@@ -90,19 +122,71 @@ TOOLS = [
     },
 ]
 
+SITUATION_PROMPT = """
+You are RiddleMaster, an Agent that can conduct games for users. Users will send you messages
+with different intents. They can be about starting a new game, verifying if the locations they have
+guessed are correct, or if they want a hint. You will use the tools at your disposal to help the users
+and make the game experience enjoyable.
+Follow the instructions strictly.
+"""
+
+# how long an idle player session is kept around before it is evicted
+SESSION_TTL_SECONDS = int(os.getenv("SESSION_TTL_SECONDS", "3600"))
+
+
 class Question(BaseModel):
     data: str
+    session_token: Optional[str] = None
+    # clients that know what the player wants say so, and skip the agent
+    intent: Optional[str] = None
+    location: Optional[str] = None
+    interests: Optional[str] = None
 
 
-@app.post("/ask")
-def ask_agent(question: Question) -> Dict[str, str]:
-    api_key = ""
-
-    logger.info("Received question", question.data)
-    
-    client = Client(api_key=api_key)
-    # Use the agent server to get the answer
-    agent = client.agents.create(
+# blocking tool functions run here instead of on the event loop
+TOOL_WORKERS = int(os.getenv("TOOL_WORKERS", "64"))
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tools")
+
+_client = None
+_agent_id = None
+# the agent must not be created twice by concurrent first requests
+_agent_lock = asyncio.Lock()
+
+
+def get_client() -> "AsyncClient":
+    """Returns the julep client shared by all requests."""
+    global _client
+    if _client is None:
+        from julep import AsyncClient
+
+        kwargs = {"base_url": os.environ["JULEP_API_URL"]} if os.getenv("JULEP_API_URL") else {}
+        _client = AsyncClient(api_key=os.getenv("JULEP_API_KEY", ""), **kwargs)
+    return _client
+
+
+async def get_agent_id() -> str:
+    """Returns the id of the RiddleMaster agent, creating it only if needed.
+
+    An existing agent with ``metadata.name == "RiddleMaster"`` is reused so
+    that restarts don't leave orphan agents behind.
+    """
+    global _agent_id
+    if _agent_id is not None:
+        return _agent_id
+    async with _agent_lock:
+        if _agent_id is None:
+            _agent_id = await _find_or_create_agent()
+    return _agent_id
+
+
+async def _find_or_create_agent() -> str:
+    client = get_client()
+    for agent in await client.agents.list(metadata_filter={"name": "RiddleMaster"}):
+        if (agent.metadata or {}).get("name") == "RiddleMaster":
+            logger.info("Reusing agent %s", agent.id)
+            return agent.id
+
+    agent = await client.agents.create(
         name="RiddleMaster",
         about="An agent that will act as a game master who can conduct a riddle based game where you find the next destination to go to",
         tools=TOOLS,
@@ -118,56 +202,546 @@ def ask_agent(question: Question) -> Dict[str, str]:
         },
         metadata={"name": "RiddleMaster"},
     )
+    logger.info("Created agent %s", agent.id)
+    return agent.id
 
-    SITUATION_PROMPT = """
-    You are RiddleMaster, an Agent that can conduct games for users. Users will send you messages
-    with different intents. They can be about starting a new game, verifying if the locations they have
-    guessed are correct, or if they want a hint. You will use the tools at your disposal to help the users
-    and make the game experience enjoyable.
-    Follow the instructions strictly.
+
+class SessionRegistry:
+    """Maps player session tokens to julep session ids.
+
+    Sessions that haven't been used for ``ttl`` seconds are evicted and
+    deleted on the julep side. The registry is only used from the event
+    loop, so it needs no locking.
     """
 
-    session = client.sessions.create(
-        agent_id=agent.id,
-        situation=SITUATION_PROMPT,
-        metadata={"agent_id": agent.id},
-    )
+    def __init__(self, ttl: int = SESSION_TTL_SECONDS):
+        self.ttl = ttl
+        # ordered from the least to the most recently used session
+        self._sessions: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._creating: Dict[str, asyncio.Future] = {}
+
+    async def get_or_create(self, token: str) -> str:
+        now = time.time()
+        while self._sessions:
+            key, (session_id, last_used) = next(iter(self._sessions.items()))
+            if now - last_used <= self.ttl:
+                break
+            del self._sessions[key]
+            asyncio.ensure_future(self._delete(session_id))
+
+        entry = self._sessions.get(token)
+        if entry is not None:
+            self._sessions[token] = (entry[0], now)
+            self._sessions.move_to_end(token)
+            return entry[0]
+
+        # two requests of a new player must not create two sessions
+        if token in self._creating:
+            return await asyncio.shield(self._creating[token])
+        future = self._creating[token] = asyncio.get_running_loop().create_future()
+        try:
+            agent_id = await get_agent_id()
+            session = await get_client().sessions.create(
+                agent_id=agent_id,
+                situation=SITUATION_PROMPT,
+                metadata={"agent_id": agent_id, "session_token": token},
+            )
+            self._sessions[token] = (session.id, now)
+            future.set_result(session.id)
+            return session.id
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            del self._creating[token]
+
+    async def _delete(self, session_id: str):
+        try:
+            await get_client().sessions.delete(session_id=session_id)
+        except Exception:
+            logger.warning("Could not delete expired session %s", session_id)
+
+
+sessions = SessionRegistry()
+
+
+async def warm_agent():
+    # the julep SDK is imported off the event loop
+    await asyncio.to_thread(get_client)
+    await get_agent_id()
+
 
-    response = client.sessions.chat(
-        session_id=session.id,
-        messages=[
-            {
-                "role": "user",
-                "content": question.data,
-            }
-        ],
-        recall=True,
-        remember=True,
+# what has to be up before the server is ready, built concurrently at boot
+WARM_UP = {
+    "agent": warm_agent,
+    "openai": lambda: asyncio.to_thread(get_openai_client),
+    "maps": lambda: asyncio.to_thread(lambda: get_maps_client() and get_transport()),
+    "completion_cache": lambda: asyncio.to_thread(get_completion_cache),
+    "tile_packs": lambda: asyncio.to_thread(get_tile_packs),
+    "game_state": lambda: asyncio.to_thread(get_state_backend),
+}
+
+# seconds between two attempts to warm up what failed
+WARM_UP_RETRY_SECONDS = float(os.getenv("WARM_UP_RETRY_SECONDS", "5"))
+
+readiness = {"ready": False, "components": {name: "pending" for name in WARM_UP}}
+
+
+async def warm_up():
+    """Builds the shared clients and warms the agent and caches concurrently.
+
+    Components that fail are retried until all of them are up, and only then
+    is the server ready.
+    """
+    pending = dict(WARM_UP)
+    while pending:
+        names = list(pending)
+        results = await asyncio.gather(*(pending[name]() for name in names), return_exceptions=True)
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                logger.warning("Warming up %s failed: %s", name, result)
+                readiness["components"][name] = f"error: {result}"
+            else:
+                readiness["components"][name] = "ok"
+                del pending[name]
+        if pending:
+            await asyncio.sleep(WARM_UP_RETRY_SECONDS)
+
+    ready_seconds = time.perf_counter() - _import_started
+    readiness.update(ready=True, ready_seconds=round(ready_seconds, 3))
+    observe("startup_seconds", ready_seconds, phase="ready")
+    logger.info("Ready %.2f s after the first import", ready_seconds)
+    if warm_pool is not None:
+        warm_pool.start()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    observe("startup_seconds", IMPORT_SECONDS, phase="import")
+    logger.info("Imports took %.2f s", IMPORT_SECONDS)
+    # the server takes health checks while warming up, /readyz tells when
+    # it can take traffic
+    task = asyncio.ensure_future(warm_up())
+    yield
+    task.cancel()
+    if warm_pool is not None:
+        warm_pool.stop()
+    if event_log is not None:
+        event_log.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Runs a blocking function on the tool executor.
+
+    The caller's context is carried over, so progress listeners keep working.
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        tool_executor, functools.partial(context.run, fn, *args, **kwargs)
     )
 
+
+# a lock lives as long as someone holds or waits for it
+_game_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def game_lock(token: str) -> asyncio.Lock:
+    """Returns the lock that serializes the tools run for a player's game.
+
+    Tools read the game state, change it and write it back, so two of them
+    running at once for one game, e.g. a hint and an answer, lose one
+    change. Every tool call holds this lock. It only covers this process,
+    the state backends keep changes made by other workers apart.
+    """
+    lock = _game_locks.get(token)
+    if lock is None:
+        lock = _game_locks[token] = asyncio.Lock()
+    return lock
+
+
+# the functions the agent may call, by tool name. each one takes the
+# player's session token and the arguments chosen by the agent.
+TOOL_DISPATCH = {
+    "start_game": lambda token, params: start_game(
+        params["current_location"], params["user_interests"], game_id=token
+    ),
+    "verify": lambda token, params: verify(params["current_location"], game_id=token),
+    "get_hint": lambda token, params: get_hint(game_id=token),
+}
+
+
+async def run_tool(name: str, token: str, params: Dict) -> str:
+    """Runs a tool off the event loop and records the outbound calls it made."""
+    calls_before = request_counts().get("api_calls", 0)
+    async with game_lock(token):
+        with span(f"tool.{name}"):
+            result = await run_blocking(TOOL_DISPATCH[name], token, params)
+    # the outbound calls made by the tool itself
+    observe("tool_api_calls", request_counts().get("api_calls", 0) - calls_before, tool=name)
+    return result
+
+
+async def answer(question: Question, token: str):
+    """Runs the tool a question asks for, letting the agent pick it if that isn't clear."""
+    try:
+        # the game state may live in another process, so this runs off the loop
+        routed = await run_blocking(
+            route, question.data, question.intent, question.location, question.interests,
+            game_active=lambda: has_active_game(token),
+        )
+    except ValueError as e:
+        raise HTTPException(400, str(e))
+    if routed is not None:
+        # the agent's session doesn't see these turns, it only has to
+        # follow the conversation when the player says something unclear
+        tool, params = routed
+        return {"response": await run_tool(tool, token, params)}
+
+    with span("session"):
+        session_id = await sessions.get_or_create(token)
+
+    report("thinking")
+    with span("julep_chat"):
+        response = await get_client().sessions.chat(
+            session_id=session_id,
+            messages=[
+                {
+                    "role": "user",
+                    "content": question.data,
+                }
+            ],
+            recall=True,
+            remember=True,
+        )
+    count("api_calls", provider="julep", endpoint="chat")
+
     if response.finish_reason == "tool_calls":
         json_response = json.loads(response.response[0][0].content)
         function_name = json_response["name"]
         function_params = json.loads(json_response["arguments"])
 
-        if function_name == "start_game":
-            current_location = function_params["current_location"]
-            user_interests = function_params["user_interests"]
-            riddle = start_game(current_location, user_interests)
-            return riddle
-
-        if function_name == "verify":
-            current_location = function_params["current_location"]
-            response = verify(current_location)
-            return response
-
-        if function_name == "get_hint":
-            hint = get_hint()
-            return hint
-        
+        if function_name in TOOL_DISPATCH:
+            # tools return plain text, answer in the same shape as the agent
+            return {"response": await run_tool(function_name, token, function_params)}
+        logger.warning("The agent called an unknown tool %s", function_name)
+
     return {"response" : response.response[0][0].content}
 
 
+def session_token(question: Question, http_response: Response) -> str:
+    # the token identifies the player; hand it back so that the next request
+    # lands in the same session
+    token = question.session_token or uuid.uuid4().hex
+    http_response.headers["X-Session-Token"] = token
+    return token
+
+
+@app.post("/ask")
+async def ask_agent(question: Question, http_response: Response) -> Dict[str, str]:
+    logger.info("Received question: %s", question.data)
+    token = session_token(question, http_response)
+    return await answer(question, token)
+
+
+@app.middleware("http")
+async def time_request(request: Request, call_next):
+    """Records the spans of a request and reports them on request.
+
+    Clients that send ``X-Timing: 1`` get a Server-Timing header with the
+    time spent in every stage.
+    """
+    with record_request() as timings:
+        with span(f"request.{request.url.path}"):
+            response = await call_next(request)
+    if request.headers.get("X-Timing") == "1" and timings.spans:
+        response.headers["Server-Timing"] = timings.server_timing()
+    return response
+
+
+@app.get("/metrics")
+def metrics() -> PlainTextResponse:
+    """Exposes the pipeline metrics in the Prometheus text format."""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/stats")
+def stats() -> Dict[str, Dict]:
+    """Returns the outbound HTTP, hedge pool, rate limit, cache, intent router, warm pool and event log statistics."""
+    stats = {
+        "http": get_transport().stats(),
+        "hedge_pool": get_transport().hedge_pool_stats(),
+        "rate_limits": scheduler.stats(),
+        "maps_cache": get_cache().stats(),
+        "intents": intent_stats(),
+    }
+    if warm_pool is not None:
+        stats["warm_pool"] = warm_pool.stats()
+    if event_log is not None:
+        stats["event_log"] = event_log.stats()
+    return stats
+
+
+@app.get("/healthz")
+def healthz() -> Dict[str, str]:
+    """Tells that the process is alive."""
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+def readyz() -> JSONResponse:
+    """Tells whether the shared clients are built and the agent is known."""
+    body = dict(readiness, import_seconds=round(IMPORT_SECONDS, 3))
+    return JSONResponse(body, status_code=200 if readiness["ready"] else 503)
+
+
+# the largest photo /verify/image accepts, in bytes
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(10 * 1024 * 1024)))
+
+
+@app.post("/verify/image")
+async def verify_image(request: Request, http_response: Response) -> Dict[str, str]:
+    """Checks the player's location, with a photo of the destination as proof.
+
+    The photo is either the "image" file of a multipart form with
+    "location" and "session_token" fields, or the raw request body with
+    ``location`` and ``session_token`` in the query string. No base64 and
+    no agent round trip is involved.
+    """
+    if int(request.headers.get("content-length") or 0) > MAX_IMAGE_BYTES:
+        raise HTTPException(413, "The image is too large")
+
+    fields = dict(request.query_params)
+    if request.headers.get("content-type", "").startswith("multipart/form-data"):
+        form = await request.form(max_files=1)
+        upload = form.get("image")
+        if upload is None or isinstance(upload, str):
+            raise HTTPException(400, "The form has no image file")
+        image = await upload.read()
+        fields.update((key, value) for key, value in form.items() if isinstance(value, str))
+    else:
+        image = await request.body()
+    if not image or len(image) > MAX_IMAGE_BYTES:
+        raise HTTPException(413 if image else 400, "The image is too large" if image else "The image is missing")
+
+    location = fields.get("location", "")
+    try:
+        parse_lat_lng(location)
+    except ValueError:
+        raise HTTPException(400, 'The location has to be "lat,lng"')
+
+    token = fields.get("session_token") or request.headers.get("X-Session-Token") or uuid.uuid4().hex
+    http_response.headers["X-Session-Token"] = token
+    async with game_lock(token):
+        with span("tool.verify"):
+            result = await run_blocking(verify, location, image=image, game_id=token)
+    return {"response": result}
+
+
+def sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post("/ask/stream")
+async def ask_agent_stream(question: Question, http_response: Response) -> StreamingResponse:
+    """Answers like /ask but streams Server-Sent Events while working on it.
+
+    ``progress`` events name the stage that is running, ``token`` events carry
+    riddle and hint text as it is generated and the final answer is sent as
+    a ``result`` event (or ``error`` if something failed).
+    """
+    logger.info("Received question to stream: %s", question.data)
+    token = session_token(question, http_response)
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def on_event(event, data):
+        # events are emitted from the tool executor threads too
+        loop.call_soon_threadsafe(events.put_nowait, sse(event, data))
+
+    async def run():
+        with listen(on_event):
+            try:
+                result = await answer(question, token)
+                events.put_nowait(sse("result", result))
+            except Exception as e:
+                logger.exception("Streaming answer failed")
+                events.put_nowait(sse("error", {"error": str(e)}))
+        # let the events queued from other threads arrive first
+        loop.call_soon_threadsafe(events.put_nowait, None)
+
+    task = asyncio.ensure_future(run())
+
+    async def stream():
+        try:
+            while True:
+                event = await events.get()
+                if event is None:
+                    return
+                yield event
+        finally:
+            task.cancel()
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"X-Session-Token": token, "Cache-Control": "no-cache"},
+    )
+
+
+# how long location fixes are collected before they are checked together, in seconds
+LOCATION_BATCH_SECONDS = float(os.getenv("LOCATION_BATCH_SECONDS", "0.05"))
+
+
+class LocationChannel:
+    """Checks the location fixes streamed by all connected players together.
+
+    Fixes are collected for ``interval`` seconds and checked against the
+    targets of all games in one vectorized pass. A newer fix of a player
+    replaces one that wasn't checked yet, and only the players that reached
+    their target go through `check_answer`, holding their `game_lock`. The
+    channel is only used from the event loop, so it needs no locking.
+    """
+
+    def __init__(self, interval: float = LOCATION_BATCH_SECONDS):
+        self.interval = interval
+        self._pending: Dict[str, Tuple[str, Callable]] = {}
+        # players whose answer is being checked, their fixes are ignored meanwhile
+        self._checking: Set[str] = set()
+        self._flush: Optional[asyncio.Future] = None
+
+    def submit(self, token: str, location: str, push: Callable[[str, Dict], None]):
+        """Queues a fix, ``push(event, data)`` gets the events it leads to."""
+        self._pending[token] = (location, push)
+        if self._flush is None:
+            self._flush = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        await asyncio.sleep(self.interval)
+        pending, self._pending, self._flush = self._pending, {}, None
+        pings = [(token, location) for token, (location, _) in pending.items() if token not in self._checking]
+        if not pings:
+            return
+        observe("location_batch_size", len(pings), SIZE_BUCKETS)
+        try:
+            found = await run_blocking(reached_targets, pings)
+        except Exception:
+            logger.exception("Checking %d location fixes failed", len(pings))
+            return
+        for (token, location), hit in zip(pings, found):
+            count("location_fixes", result="hit" if hit else "miss")
+            if hit:
+                self._checking.add(token)
+                asyncio.ensure_future(self._check(token, location, pending[token][1]))
+
+    async def _check(self, token: str, location: str, push: Callable[[str, Dict], None]):
+        try:
+            async with game_lock(token):
+                with listen(push), span("tool.verify"):
+                    outcome, message = await run_blocking(check_answer, location, game_id=token)
+            push(outcome, {"text": message})
+        except Exception as e:
+            logger.exception("Checking the answer of %s failed", token)
+            push("error", {"error": str(e)})
+        finally:
+            self._checking.discard(token)
+
+
+locations = LocationChannel()
+
+
+@app.websocket("/ws")
+async def play(websocket: WebSocket):
+    """Plays a game over a WebSocket, without the agent.
+
+    The player's session token is the ``session_token`` query parameter, a
+    new one is handed out in a ``session`` event if it is missing. The
+    player sends JSON messages:
+
+        {"type": "start", "location": "lat,lng", "interests": "..."}
+        {"type": "location", "location": "lat,lng"}
+        {"type": "hint"}
+
+    and gets ``{"event": ..., "data": ...}`` messages back: ``riddle`` with
+    the next riddle, ``hint``, ``complete`` and ``expired`` when the game is
+    over, ``no_game``, ``progress`` and ``token`` while working, and
+    ``error``. Location fixes only lead to an event once the target is
+    reached, so clients can stream them as often as they get them.
+    """
+    await websocket.accept()
+    token = websocket.query_params.get("session_token") or uuid.uuid4().hex
+    loop = asyncio.get_running_loop()
+    outbox = asyncio.Queue()
+
+    def push(event: str, data: Dict):
+        # events are emitted from the tool executor threads too
+        loop.call_soon_threadsafe(outbox.put_nowait, {"event": event, "data": data})
+
+    async def write():
+        while True:
+            await websocket.send_json(await outbox.get())
+
+    async def run(fn, *args, **kwargs):
+        with listen(push):
+            try:
+                return await run_blocking(fn, *args, **kwargs)
+            except Exception as e:
+                logger.exception("%s failed for %s", fn.__name__, token)
+                push("error", {"error": str(e)})
+
+    async def start(location: str, interests: str):
+        async with game_lock(token):
+            with span("tool.start_game"):
+                result = await run(start_game, location, interests, game_id=token)
+        if result is not None:
+            push("error" if result in (NO_PLACES_MESSAGE, NO_LOCATION_MESSAGE) else "riddle", {"text": result})
+
+    async def hint():
+        async with game_lock(token):
+            with span("tool.get_hint"):
+                result = await run(get_hint, game_id=token)
+        if result is not None:
+            push("no_game" if result == NO_GAME_MESSAGE else "hint", {"text": result})
+
+    writer = asyncio.ensure_future(write())
+    tasks: Set[asyncio.Future] = set()
+    push("session", {"session_token": token})
+    count("ws_connections")
+    try:
+        while True:
+            try:
+                message = json.loads(await websocket.receive_text())
+                kind = message.get("type")
+                location = message.get("location")
+                if kind in ("start", "location"):
+                    parse_lat_lng(location or "")
+            except (ValueError, AttributeError):
+                push("error", {"error": 'Messages have to be JSON objects with a "type" and a "lat,lng" location'})
+                continue
+            count("ws_messages", type=kind if kind in ("start", "location", "hint") else "unknown")
+
+            if kind == "location":
+                locations.submit(token, location, push)
+                continue
+            if kind == "start":
+                task = asyncio.ensure_future(start(location, message.get("interests") or ""))
+            elif kind == "hint":
+                task = asyncio.ensure_future(hint())
+            else:
+                push("error", {"error": f"Unknown message type {kind}"})
+                continue
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        writer.cancel()
+        for task in tasks:
+            task.cancel()
+
+
 if __name__ == "__main__":
     import uvicorn
     # run server locally
@@ -0,0 +1,189 @@
+"""Replays a recorded event log against agent_server and the stub.
+
+Every start_game, verify and get_hint call of the log is sent to /ask with
+its recorded arguments, session and timing, so the load has the shape of
+the recorded traffic. The stub only knows the places around the center of
+its fixtures, so every session is moved there: all of its locations are
+shifted by the offset between its first location and the fixture center,
+which keeps the distances the player walked. The report puts the replayed
+latencies and outbound calls next to the recorded ones:
+
+    python -m bench.replay events/*.events --speed 10 --latency-ms 80
+"""
+import argparse
+import json
+import os
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import numpy as np
+import requests
+
+from bench.run import FIXTURES, latency_summary, print_calls, print_latencies, start_server, stub_environment
+from bench.stub_server import StubServer
+from functions.geo import parse_lat_lng
+
+# the calls of a session: (seconds since the start of the log, tool, arguments)
+Calls = List[Tuple[float, str, Dict]]
+
+
+def load_calls(columns: Dict[str, np.ndarray]) -> Dict[str, Calls]:
+    """Returns the recorded tool calls of every session, in order."""
+    sessions: Dict[str, Calls] = defaultdict(list)
+    tools = columns["kind"] == "tool"
+    if not tools.any():
+        return sessions
+    started = columns["time"][tools][0]
+    for at, name, session, args in zip(
+        columns["time"][tools], columns["name"][tools], columns["session"][tools], columns["args"][tools]
+    ):
+        sessions[str(session)].append((float(at - started), str(name), json.loads(str(args) or "{}")))
+    return sessions
+
+
+def move_sessions(sessions: Dict[str, Calls], center: Tuple[float, float]) -> Dict[str, Calls]:
+    """Shifts the locations of every session so that it starts at ``center``."""
+    moved = {}
+    for session, calls in sessions.items():
+        first = next((args["current_location"] for _, _, args in calls if args.get("current_location")), None)
+        if first is None:
+            moved[session] = calls
+            continue
+        lat, lng = parse_lat_lng(first)
+        dlat, dlng = center[0] - lat, center[1] - lng
+        moved[session] = []
+        for at, name, args in calls:
+            if args.get("current_location"):
+                lat, lng = parse_lat_lng(args["current_location"])
+                args = dict(args, current_location=f"{lat + dlat:.6f},{lng + dlng:.6f}")
+            moved[session].append((at, name, args))
+    return moved
+
+
+def recorded_summary(columns: Dict[str, np.ndarray]) -> Dict:
+    """Summarizes the recorded tool latencies, outbound calls and cache outcomes."""
+    tools = columns["kind"] == "tool"
+    latencies = defaultdict(list)
+    for name, seconds in zip(columns["name"][tools], columns["seconds"][tools]):
+        latencies[str(name)].append(float(seconds))
+    counts = columns["kind"] == "count"
+    outcomes = Counter(zip(columns["name"][counts], columns["outcome"][counts]))
+    return {
+        "latency_ms": latency_summary(latencies),
+        # the label values are endpoint/provider
+        "outbound_calls": {
+            "/".join(reversed(outcome.split("/"))): calls
+            for (name, outcome), calls in sorted(outcomes.items()) if name == "api_calls"
+        },
+        "cache": {
+            f"{name}/{outcome}": hits
+            for (name, outcome), hits in sorted(outcomes.items()) if name in ("maps_cache", "llm_cache", "tile_pack")
+        },
+    }
+
+
+def replay_session(url: str, token: str, calls: Calls, started: float, speed: float,
+                   latencies: Dict[str, List[float]], lags: List[float], lock: threading.Lock):
+    session = requests.Session()
+    for at, name, args in calls:
+        delay = started + at / speed - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        body = {
+            "data": "",
+            "session_token": token,
+            "intent": name,
+            "location": args.get("current_location"),
+            "interests": args.get("user_interests"),
+        }
+        sent = time.perf_counter()
+        response = session.post(f"{url}/ask", json=body)
+        elapsed = time.perf_counter() - sent
+        with lock:
+            latencies[name if response.ok else f"{name} error"].append(elapsed)
+            # how far behind the recorded schedule the call was sent
+            lags.append(max(0.0, -delay))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a recorded event log against recorded API responses.")
+    parser.add_argument("logs", nargs="+", help="the .events files to replay")
+    parser.add_argument("--fixtures", default=FIXTURES)
+    parser.add_argument("--speed", type=float, default=1.0, help="how many times faster than recorded")
+    parser.add_argument("--concurrency", type=int, default=256, help="sessions replayed at the same time")
+    parser.add_argument("--latency-ms", type=float, default=50, help="injected latency of every stubbed call")
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--keep-locations", action="store_true",
+                        help="replay the recorded locations instead of moving the sessions to the fixture center")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    # the replay itself is not logged
+    os.environ.pop("EVENT_LOG_DIR", None)
+    from functions.events import read
+
+    columns = read(args.logs)
+    sessions = load_calls(columns)
+    if not sessions:
+        parser.error("the logs have no tool calls")
+
+    with open(args.fixtures) as f:
+        fixtures = json.load(f)
+    if not args.keep_locations:
+        sessions = move_sessions(sessions, tuple(fixtures["center"]))
+    stub = StubServer(fixtures, latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000)
+    stub.start()
+    stub_environment(stub)
+    start_server(args.port)
+    url = f"http://127.0.0.1:{args.port}"
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    lags: List[float] = []
+    lock = threading.Lock()
+    run = uuid.uuid4().hex[:8]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        replays = [
+            executor.submit(replay_session, url, f"replay-{run}-{session}", calls, started, args.speed,
+                            latencies, lags, lock)
+            for session, calls in sessions.items()
+        ]
+        for replay in replays:
+            replay.result()
+    elapsed = time.perf_counter() - started
+
+    total = sum(len(values) for values in latencies.values())
+    report = {
+        "sessions": len(sessions),
+        "requests": total,
+        "recorded_seconds": round(max(calls[-1][0] for calls in sessions.values()), 2),
+        "seconds": round(elapsed, 2),
+        "throughput_rps": round(total / elapsed, 1),
+        "max_lag_ms": round(max(lags, default=0.0) * 1000, 1),
+        "latency_ms": latency_summary(latencies),
+        "outbound_calls": dict(sorted(stub.calls.items())),
+        "recorded": recorded_summary(columns),
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{report['sessions']} sessions, {total} requests in {report['seconds']} s "
+          f"({report['recorded_seconds']} s recorded, {report['throughput_rps']} req/s, "
+          f"up to {report['max_lag_ms']} ms behind schedule)")
+    print("replayed, whole requests:")
+    print_latencies(report["latency_ms"])
+    print("recorded, time in the tool:")
+    print_latencies(report["recorded"]["latency_ms"])
+    print_calls("outbound calls replayed:", report["outbound_calls"])
+    print_calls("outbound calls recorded:", report["recorded"]["outbound_calls"])
+    print_calls("cache outcomes recorded:", report["recorded"]["cache"])
+
+
+if __name__ == "__main__":
+    main()
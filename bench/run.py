@@ -0,0 +1,183 @@
+"""Offline load benchmark of the /ask pipeline.
+
+Runs agent_server against a local stub that replays recorded Maps, OpenAI
+and julep responses, drives it with simulated players and reports latency
+percentiles, throughput and outbound calls per game:
+
+    python -m bench.run --players 50 --pings 20 --latency-ms 80
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import requests
+
+from bench.stub_server import StubServer
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "berlin.json")
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+def stub_environment(stub: StubServer):
+    """Points every client at the stub, before the server modules are imported."""
+    workdir = tempfile.mkdtemp(prefix="bench-")
+    os.environ.update({
+        "MAPS_BASE_URL": stub.url,
+        "MAPS_API_KEY": "bench",
+        "MAPS_CACHE_DB": os.path.join(workdir, "maps_cache.db"),
+        "COMPLETION_CACHE_DB": os.path.join(workdir, "completion_cache.db"),
+        "OPENAI_BASE_URL": f"{stub.url}/v1",
+        "OPENAI_API_KEY": "bench",
+        "JULEP_API_URL": f"{stub.url}/api",
+        "JULEP_API_KEY": "bench",
+    })
+
+
+def latency_summary(latencies: Dict[str, List[float]]) -> Dict[str, Dict]:
+    return {
+        kind: {
+            "count": len(values),
+            "p50": round(percentile(values, 0.50) * 1000, 1),
+            "p95": round(percentile(values, 0.95) * 1000, 1),
+            "p99": round(percentile(values, 0.99) * 1000, 1),
+        }
+        for kind, values in sorted(latencies.items())
+    }
+
+
+def print_calls(title: str, calls: Dict[str, float]):
+    print(title)
+    width = max([16] + [len(endpoint) + 2 for endpoint in calls])
+    for endpoint, value in calls.items():
+        print(f"  {endpoint:<{width}}{value:>8}")
+
+
+def print_latencies(summary: Dict[str, Dict]):
+    print(f"{'request':<12}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for kind, row in summary.items():
+        print(f"{kind:<12}{row['count']:>8}{row['p50']:>10}{row['p95']:>10}{row['p99']:>10}")
+
+
+def start_server(port: int):
+    """Starts agent_server in this process and waits until it is ready."""
+    import uvicorn
+
+    from agent_server import app
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("agent_server failed to start")
+        time.sleep(0.05)
+    # the server takes requests before it is warmed up, wait for that too
+    while requests.get(f"http://127.0.0.1:{port}/readyz").status_code != 200:
+        if not thread.is_alive():
+            raise RuntimeError("agent_server failed to start")
+        time.sleep(0.05)
+    return server
+
+
+def play(url: str, fixtures: Dict, pings: int, hints: int, latencies: Dict[str, List[float]], lock: threading.Lock):
+    """Plays one game: a start, ``pings`` location checks and ``hints`` hints."""
+    session = requests.Session()
+    token = uuid.uuid4().hex
+    center = fixtures["center"]
+    places = fixtures["places"]
+
+    def ask(kind: str, data: str):
+        started = time.perf_counter()
+        response = session.post(f"{url}/ask", json={"data": data, "session_token": token})
+        elapsed = time.perf_counter() - started
+        response.raise_for_status()
+        with lock:
+            latencies[kind].append(elapsed)
+
+    ask("start_game", f"I am interested in museums, cafes and parks and my current location is {center[0]},{center[1]}")
+    requests_left = ["verify"] * pings + ["get_hint"] * hints
+    random.shuffle(requests_left)
+    for kind in requests_left:
+        if kind == "get_hint":
+            ask(kind, "I am stuck, can I get a hint?")
+        else:
+            # half of the pings stand on some place, so a few of them hit the target
+            if random.random() < 0.5:
+                location = random.choice(places)["geometry"]["location"]
+                lat, lng = location["lat"], location["lng"]
+            else:
+                lat = center[0] + random.uniform(-0.01, 0.01)
+                lng = center[1] + random.uniform(-0.01, 0.01)
+            ask(kind, f"I think I found it, I am at {lat:.6f},{lng:.6f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark /ask against recorded API responses.")
+    parser.add_argument("--fixtures", default=FIXTURES)
+    parser.add_argument("--players", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=20, help="players playing at the same time")
+    parser.add_argument("--pings", type=int, default=10, help="location checks per player")
+    parser.add_argument("--hints", type=int, default=2, help="hints per player")
+    parser.add_argument("--latency-ms", type=float, default=50, help="injected latency of every stubbed call")
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    with open(args.fixtures) as f:
+        fixtures = json.load(f)
+    stub = StubServer(fixtures, latency=args.latency_ms / 1000, jitter=args.jitter_ms / 1000)
+    stub.start()
+
+    stub_environment(stub)
+    start_server(args.port)
+    url = f"http://127.0.0.1:{args.port}"
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    lock = threading.Lock()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        games = [
+            executor.submit(play, url, fixtures, args.pings, args.hints, latencies, lock)
+            for _ in range(args.players)
+        ]
+        for game in games:
+            game.result()
+    elapsed = time.perf_counter() - started
+    # the stub keeps serving until the process exits, so that background
+    # work still queued behind the rate limits can finish
+
+    total = sum(len(values) for values in latencies.values())
+    report = {
+        "players": args.players,
+        "requests": total,
+        "seconds": round(elapsed, 2),
+        "throughput_rps": round(total / elapsed, 1),
+        "latency_ms": latency_summary(latencies),
+        "outbound_calls_per_game": {
+            endpoint: round(calls / args.players, 2) for endpoint, calls in sorted(stub.calls.items())
+        },
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{report['players']} players, {total} requests in {report['seconds']} s ({report['throughput_rps']} req/s)")
+    print_latencies(report["latency_ms"])
+    print_calls("outbound calls per game:", report["outbound_calls_per_game"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from functions.geo import haversine
+
+LOCATION_PATTERN = re.compile(r"(-?\d+\.\d+)\s*,\s*(-?\d+\.\d+)")
+
+
+def encode_polyline(points: List[Tuple[float, float]]) -> str:
+    """Encodes (lat, lng) pairs as a Google encoded polyline."""
+    encoded = []
+    previous = (0, 0)
+    for lat, lng in points:
+        current = (round(lat * 1e5), round(lng * 1e5))
+        for delta in (current[0] - previous[0], current[1] - previous[1]):
+            value = ~(delta << 1) if delta < 0 else delta << 1
+            while value >= 0x20:
+                encoded.append(chr((0x20 | (value & 0x1F)) + 63))
+                value >>= 5
+            encoded.append(chr(value + 63))
+        previous = current
+    return "".join(encoded)
+
+
+class StubServer:
+    """Replays recorded Maps, OpenAI and julep responses on a local port.
+
+    Every response is delayed by ``latency`` seconds plus up to ``jitter``
+    seconds, and every call is counted by endpoint.
+    """
+
+    def __init__(self, fixtures: Dict, latency: float = 0.05, jitter: float = 0.02, port: int = 0):
+        self.fixtures = fixtures
+        self.latency = latency
+        self.jitter = jitter
+        self.places = {place["place_id"]: place for place in fixtures["places"]}
+        self.calls: Counter = Counter()
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), self._handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    def count(self, endpoint: str):
+        with self._lock:
+            self.calls[endpoint] += 1
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, body, status=200):
+                time.sleep(stub.latency + random.uniform(0, stub.jitter))
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _stream(self, chunks: List[Dict]):
+                # the latency is the time to the first token
+                time.sleep(stub.latency + random.uniform(0, stub.jitter))
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                for chunk in chunks:
+                    self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+
+            def _body(self) -> Dict:
+                length = int(self.headers.get("Content-Length") or 0)
+                return json.loads(self.rfile.read(length) or b"{}")
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = {key: values[0] for key, values in parse_qs(url.query).items()}
+                for endpoint, handle in (
+                    ("nearbysearch", stub.nearby_search),
+                    ("details", stub.details),
+                    ("directions", stub.directions),
+                    ("distancematrix", stub.distance_matrix),
+                ):
+                    if f"/{endpoint}/" in url.path:
+                        stub.count(endpoint)
+                        return self._reply(handle(query))
+                if url.path.rstrip("/").endswith("/agents"):
+                    stub.count("julep.agents")
+                    return self._reply({"items": []})
+                self._reply({"error": "not found"}, 404)
+
+            def do_POST(self):
+                path = urlparse(self.path).path.rstrip("/")
+                body = self._body()
+                if path.endswith("/chat/completions"):
+                    stub.count("openai.chat")
+                    if body.get("stream"):
+                        return self._stream(stub.completion_chunks(body))
+                    return self._reply(stub.completion(body))
+                if path.endswith("/chat"):
+                    stub.count("julep.chat")
+                    return self._reply(stub.chat(body))
+                if path.endswith("/agents") or path.endswith("/sessions"):
+                    stub.count("julep." + path.rsplit("/", 1)[1])
+                    return self._reply({"id": str(uuid.uuid4()), "created_at": "2024-06-15T00:00:00Z"})
+                self._reply({"error": "not found"}, 404)
+
+            def do_DELETE(self):
+                stub.count("julep.delete")
+                self._reply({})
+
+        return Handler
+
+    def _location(self, place_id: str) -> Tuple[float, float]:
+        location = self.places[place_id.replace("place_id:", "")]["geometry"]["location"]
+        return location["lat"], location["lng"]
+
+    def nearby_search(self, query: Dict) -> Dict:
+        lat, lng = (float(x) for x in query["location"].split(","))
+        radius = float(query.get("radius", 50))
+        keyword = query.get("keyword", "").lower().replace(" ", "_")
+        results = [
+            place for place in self.fixtures["places"]
+            if haversine(lat, lng, place["geometry"]["location"]["lat"], place["geometry"]["location"]["lng"]) <= radius
+            and (not keyword or any(keyword in t or t in keyword for t in place["types"]))
+        ]
+        results.sort(key=lambda place: -place["user_ratings_total"])
+        return {"status": "OK" if results else "ZERO_RESULTS", "results": results[:20]}
+
+    def details(self, query: Dict) -> Dict:
+        place = self.places.get(query["place_id"])
+        if place is None:
+            return {"status": "NOT_FOUND"}
+        return {"status": "OK", "result": dict(place, **self.fixtures["details_extra"])}
+
+    def directions(self, query: Dict) -> Dict:
+        start, end = self._location(query["origin"]), self._location(query["destination"])
+        points = [(start[0] + (end[0] - start[0]) * i / 20, start[1] + (end[1] - start[1]) * i / 20) for i in range(21)]
+        distance = haversine(*start, *end)
+        return {
+            "status": "OK",
+            "routes": [{
+                "overview_polyline": {"points": encode_polyline(points)},
+                "legs": [{
+                    "distance": {"value": int(distance)},
+                    "duration": {"value": int(distance / 1.4)},
+                    "steps": [{"end_location": {"lat": lat, "lng": lng}} for lat, lng in points[5::5]],
+                }],
+            }],
+        }
+
+    def distance_matrix(self, query: Dict) -> Dict:
+        origins = query["origins"].split("|")
+        destinations = query["destinations"].split("|")
+        rows = []
+        for origin in origins:
+            elements = []
+            for destination in destinations:
+                distance = haversine(*self._location(origin), *self._location(destination))
+                elements.append({
+                    "status": "OK",
+                    "distance": {"value": int(distance)},
+                    "duration": {"value": int(distance / 1.4)},
+                })
+            rows.append({"elements": elements})
+        return {"status": "OK", "rows": rows}
+
+    def completion(self, body: Dict) -> Dict:
+        prompt = body["messages"][-1]["content"]
+        completions = self.fixtures["completions"]
+        if isinstance(prompt, list):
+            # a photo check, every photo shows the right place
+            prompt = prompt[0]["text"]
+            content = "yes"
+        elif body.get("response_format", {}).get("type") == "json_schema":
+            # a game plan, with a riddle and two hints for every leg
+            legs = len(re.findall(r"^Leg \d+:", prompt, re.MULTILINE))
+            content = json.dumps({"legs": [
+                {"riddle": completions["riddle"], "hints": [completions["hint"], completions["hint"]]}
+                for _ in range(legs)
+            ]})
+        elif "keywords" in prompt:
+            content = completions["keywords"]
+        elif "hint" in prompt:
+            content = completions["hint"]
+        else:
+            content = completions["riddle"]
+        return {
+            "id": "chatcmpl-bench",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-3.5-turbo"),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4, "total_tokens": 0},
+        }
+
+    def completion_chunks(self, body: Dict) -> List[Dict]:
+        """Splits the completion into the chunks of a streamed answer, a word each."""
+        completion = self.completion(body)
+        content = completion["choices"][0]["message"]["content"]
+        deltas = [{"role": "assistant", "content": ""}] + [{"content": word} for word in re.findall(r"\S+\s*", content)]
+        chunks = [
+            {"index": 0, "delta": delta, "finish_reason": None} for delta in deltas
+        ] + [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+        return [
+            {
+                "id": completion["id"],
+                "object": "chat.completion.chunk",
+                "created": completion["created"],
+                "model": completion["model"],
+                "choices": [choice],
+            }
+            for choice in chunks
+        ]
+
+    def chat(self, body: Dict) -> Dict:
+        """Plays the agent: picks a tool from the wording of the message."""
+        message = body["messages"][-1]["content"]
+        location = LOCATION_PATTERN.search(message)
+        call: Optional[Dict] = None
+        if "hint" in message.lower():
+            call = {"name": "get_hint", "arguments": "{}"}
+        elif location and ("interested" in message.lower() or "start" in message.lower()):
+            interests = message.split(" and my current location")[0]
+            call = {"name": "start_game", "arguments": json.dumps({
+                "current_location": f"{location.group(1)},{location.group(2)}",
+                "user_interests": interests,
+            })}
+        elif location:
+            call = {"name": "verify", "arguments": json.dumps({
+                "current_location": f"{location.group(1)},{location.group(2)}",
+            })}
+
+        if call is None:
+            content, finish_reason = self.fixtures["chat"]["reply"], "stop"
+        else:
+            content, finish_reason = json.dumps(call), "tool_calls"
+        return {
+            "id": str(uuid.uuid4()),
+            "finish_reason": finish_reason,
+            "response": [[{
+                "id": str(uuid.uuid4()),
+                "created_at": "2024-06-15T00:00:00Z",
+                "role": "assistant",
+                "content": content,
+            }]],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            "jobs": [],
+            "doc_ids": {"agent_doc_ids": [], "user_doc_ids": []},
+        }
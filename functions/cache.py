@@ -0,0 +1,73 @@
+import json
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, Optional
+
+
+class ResponseCache:
+    """A persistent key-value cache backed by SQLite.
+
+    Entries expire after the ttl they were stored with, and once more than
+    ``max_entries`` are stored the least recently used ones are evicted.
+    Hits and misses are counted per namespace (e.g. the Maps endpoint).
+    """
+
+    def __init__(self, path: str, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self.hits: Dict[str, int] = defaultdict(int)
+        self.misses: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        with self._lock, self._conn:
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, namespace TEXT NOT NULL, value TEXT NOT NULL, "
+                "expires_at REAL NOT NULL, last_used REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS cache_last_used ON cache (last_used)")
+
+    def get(self, namespace: str, key: str, allow_stale: bool = False) -> Optional[Any]:
+        """Returns the value stored under key, or None.
+
+        With ``allow_stale`` expired values are returned too, which is
+        better than nothing when the origin is unavailable.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (row[1] < now and not allow_stale):
+                self.misses[namespace] += 1
+                return None
+            with self._conn:
+                self._conn.execute("UPDATE cache SET last_used = ? WHERE key = ?", (now, key))
+            self.hits[namespace] += 1
+        return json.loads(row[0])
+
+    def put(self, namespace: str, key: str, value: Any, ttl: float):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, namespace, value, expires_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, namespace, json.dumps(value), now + ttl, now),
+            )
+            count = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM cache WHERE key IN "
+                    "(SELECT key FROM cache ORDER BY last_used LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        namespaces = set(self.hits) | set(self.misses)
+        return {
+            namespace: {"hits": self.hits[namespace], "misses": self.misses[namespace]}
+            for namespace in sorted(namespaces)
+        }
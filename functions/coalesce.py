@@ -0,0 +1,83 @@
+import contextvars
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Tuple
+
+
+class SingleFlight:
+    """Lets concurrent callers asking for the same key share one call.
+
+    The first caller of a key runs the function, everybody else asking for
+    the key while it is in flight waits for that result (or exception).
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+        self.shared = 0
+
+    def do(self, key: Hashable, fn: Callable, *args, **kwargs) -> Any:
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+            else:
+                self.shared += 1
+        if not leader:
+            return future.result()
+
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return future.result()
+
+
+class MicroBatcher:
+    """Collects lookups for a short window and runs each distinct key once.
+
+    Callers block until the batch their key landed in has been resolved. A
+    key is resolved in the context of its first caller, so its priority,
+    progress listener and metrics carry over.
+    """
+
+    def __init__(self, fn: Callable[[Hashable], Any], window: float, max_workers: int = 8):
+        self.fn = fn
+        self.window = window
+        self._pending: Dict[Hashable, Tuple[Future, contextvars.Context]] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="batch")
+
+    def get(self, key: Hashable) -> Any:
+        if self.window <= 0:
+            return self.fn(key)
+
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is None:
+                if not self._pending:
+                    timer = threading.Timer(self.window, self._flush)
+                    timer.daemon = True
+                    timer.start()
+                pending = self._pending[key] = (Future(), contextvars.copy_context())
+        return pending[0].result()
+
+    def _flush(self):
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        for key, (future, context) in batch.items():
+            try:
+                self._executor.submit(context.run, self._resolve, key, future)
+            except RuntimeError:
+                # the executor is shut down when the interpreter exits
+                context.run(self._resolve, key, future)
+
+    def _resolve(self, key: Hashable, future: Future):
+        try:
+            future.set_result(self.fn(key))
+        except BaseException as e:
+            future.set_exception(e)
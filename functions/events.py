@@ -0,0 +1,245 @@
+"""An append-only log of what the game pipeline does, for capacity planning.
+
+The metrics hooks feed it every span (tool calls, outbound requests, LLM
+calls and whole requests, with their latencies) and every counted outcome
+(cache hits and misses, API calls, ...). The game tools add their
+arguments, so that a log can be replayed with ``python -m bench.replay``.
+
+Recording only appends a tuple to a buffer. A background thread writes the
+buffer every EVENT_LOG_FLUSH_SECONDS as one chunk of numpy columns:
+
+    time (float64), seconds (float32, NaN for counts) and the dictionary
+    encoded strings kind, name, session, outcome and args
+
+Files start with MAGIC, followed by chunks that are an 8 byte little endian
+length and a compressed .npz archive. A new file is started every
+EVENT_LOG_ROTATE_SECONDS or once a file has EVENT_LOG_MAX_BYTES, and only
+the newest EVENT_LOG_KEEP files are kept.
+"""
+import atexit
+import contextvars
+import functools
+import glob
+import inspect
+import io
+import json
+import math
+import os
+import struct
+import threading
+import time
+from logging import getLogger
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+logger = getLogger(__name__)
+
+# the log is off unless it has a directory to write to
+EVENT_LOG_DIR = os.getenv("EVENT_LOG_DIR")
+
+FLUSH_SECONDS = float(os.getenv("EVENT_LOG_FLUSH_SECONDS", "1"))
+# a flush starts early once this many events are buffered
+BATCH_SIZE = int(os.getenv("EVENT_LOG_BATCH", "4096"))
+# events beyond this many buffered ones are dropped rather than slowing requests down
+MAX_BUFFERED = int(os.getenv("EVENT_LOG_MAX_BUFFERED", "100000"))
+
+ROTATE_SECONDS = float(os.getenv("EVENT_LOG_ROTATE_SECONDS", "3600"))
+MAX_BYTES = int(os.getenv("EVENT_LOG_MAX_BYTES", str(64 * 1024 * 1024)))
+KEEP_FILES = int(os.getenv("EVENT_LOG_KEEP", "168"))
+
+MAGIC = b"GEVL1\n"
+STRING_COLUMNS = ("kind", "name", "session", "outcome", "args")
+
+Event = Tuple[float, str, str, str, float, str, str]
+
+_session: contextvars.ContextVar[str] = contextvars.ContextVar("event_session", default="")
+
+
+def encode_chunk(events: List[Event]) -> bytes:
+    """Packs events into the columns of one compressed chunk."""
+    times, kinds, names, sessions, seconds, outcomes, args = zip(*events)
+    columns = {
+        "time": np.asarray(times, dtype=np.float64),
+        "seconds": np.asarray(seconds, dtype=np.float32),
+    }
+    for name, values in zip(STRING_COLUMNS, (kinds, names, sessions, outcomes, args)):
+        # every column holds few distinct strings, so they are stored once
+        # and referenced by their index
+        unique, codes = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+        columns[name] = codes.astype(np.uint16 if len(unique) <= 1 << 16 else np.uint32)
+        columns[f"{name}_values"] = unique
+    encoded = io.BytesIO()
+    np.savez_compressed(encoded, **columns)
+    return encoded.getvalue()
+
+
+def decode_chunk(data: bytes) -> Dict[str, np.ndarray]:
+    with np.load(io.BytesIO(data), allow_pickle=False) as archive:
+        columns = {"time": archive["time"], "seconds": archive["seconds"]}
+        for name in STRING_COLUMNS:
+            columns[name] = archive[f"{name}_values"][archive[name]]
+    return columns
+
+
+def read_chunks(path: str) -> Iterator[Dict[str, np.ndarray]]:
+    """Yields the chunks of a log file, stopping at a chunk cut short by a crash."""
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an event log")
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return
+            size, = struct.unpack("<Q", header)
+            data = f.read(size)
+            if len(data) < size:
+                logger.warning("%s ends with a partial chunk", path)
+                return
+            yield decode_chunk(data)
+
+
+def read(paths: Iterable[str]) -> Dict[str, np.ndarray]:
+    """Reads log files into one set of columns, ordered by time."""
+    chunks = [chunk for path in sorted(paths) for chunk in read_chunks(path)]
+    if not chunks:
+        columns = {name: np.array([], dtype=str) for name in STRING_COLUMNS}
+        columns.update(time=np.array([], dtype=np.float64), seconds=np.array([], dtype=np.float32))
+        return columns
+    columns = {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
+    order = np.argsort(columns["time"], kind="stable")
+    return {name: values[order] for name, values in columns.items()}
+
+
+class EventLog:
+    """Buffers events and writes them in batches from a background thread."""
+
+    def __init__(self, directory: str, prefix: str = "events"):
+        self.directory = directory
+        self.prefix = prefix
+        self.written = 0
+        self.dropped = 0
+        self._buffer: List[Event] = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._file = None
+        self._opened = 0.0
+        os.makedirs(directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="event-log", daemon=True)
+        self._thread.start()
+
+    def record(self, kind: str, name: str, seconds: float = math.nan, outcome: str = "", args: str = ""):
+        with self._lock:
+            if len(self._buffer) >= MAX_BUFFERED:
+                self.dropped += 1
+                return
+            self._buffer.append((time.time(), kind, name, _session.get(), seconds, outcome, args))
+            full = len(self._buffer) >= BATCH_SIZE
+        if full:
+            self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(FLUSH_SECONDS)
+            self._wake.clear()
+            self.flush()
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+
+    def flush(self):
+        with self._lock:
+            events, self._buffer = self._buffer, []
+        if not events:
+            return
+        try:
+            chunk = encode_chunk(events)
+            f = self._current_file()
+            f.write(struct.pack("<Q", len(chunk)) + chunk)
+            f.flush()
+            self.written += len(events)
+        except Exception:
+            logger.warning("Writing %d events failed", len(events), exc_info=True)
+            self.dropped += len(events)
+
+    def _current_file(self):
+        now = time.time()
+        if self._file is not None and (now - self._opened >= ROTATE_SECONDS or self._file.tell() >= MAX_BYTES):
+            self._file.close()
+            self._file = None
+        if self._file is None:
+            stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime(now))
+            path = os.path.join(self.directory, f"{self.prefix}-{stamp}-{os.getpid()}.events")
+            self._file = open(path, "ab")
+            if self._file.tell() == 0:
+                self._file.write(MAGIC)
+            self._opened = now
+            self._prune()
+        return self._file
+
+    def _prune(self):
+        paths = sorted(glob.glob(os.path.join(self.directory, f"{self.prefix}-*.events")), key=os.path.getmtime)
+        for path in paths[:-KEEP_FILES] if KEEP_FILES > 0 else []:
+            os.remove(path)
+
+    def close(self):
+        """Writes what is buffered and stops the background thread."""
+        self._stop.set()
+        self._wake.set()
+        self._thread.join()
+
+    def stats(self) -> Dict:
+        return {
+            "written": self.written,
+            "dropped": self.dropped,
+            "buffered": len(self._buffer),
+            "file": self._file.name if self._file is not None else None,
+        }
+
+
+event_log = EventLog(EVENT_LOG_DIR) if EVENT_LOG_DIR else None
+if event_log is not None:
+    atexit.register(event_log.close)
+
+
+def record(kind: str, name: str, seconds: float = math.nan, outcome: str = "", args: str = ""):
+    """Appends an event to the log, if there is one."""
+    if event_log is not None:
+        event_log.record(kind, name, seconds, outcome, args)
+
+
+def logged(name: str, *arg_names: str, outcome: Optional[Callable] = None) -> Callable:
+    """Records the calls of a game tool with its arguments.
+
+    The events recorded during the call belong to its ``game_id``.
+
+    Args:
+        name (str): The name of the tool.
+        arg_names (str): The arguments to record, enough to replay the call.
+        outcome (Callable): Tells the outcome from the result, "ok" if not given.
+    """
+    def decorator(fn):
+        if event_log is None:
+            return fn
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            token = _session.set(str(bound.arguments.get("game_id", "")))
+            started = time.perf_counter()
+            result_outcome = "error"
+            try:
+                result = fn(*args, **kwargs)
+                result_outcome = outcome(result) if outcome is not None else "ok"
+                return result
+            finally:
+                event_log.record(
+                    "tool", name, time.perf_counter() - started, result_outcome,
+                    json.dumps({arg: bound.arguments.get(arg) for arg in arg_names}),
+                )
+                _session.reset(token)
+        return wrapper
+    return decorator
@@ -0,0 +1,125 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from typing import Dict, List, Optional, Tuple
+
+from functions.generate_riddle_function import get_directions, get_notable_sights
+from functions.llm import complete_json
+from functions.maps import get_maps_client
+from functions.metrics import count, propagate, timed
+from functions.prompts import game_plan_prompt
+
+logger = getLogger(__name__)
+
+# whether all riddles and hints of a game are written by a single completion,
+# off by default: the first riddle waits for the whole plan and can't be streamed
+PLAN_GAME = os.getenv("PLAN_GAME", "0") == "1"
+
+# the model has to support structured outputs
+PLAN_MODEL = os.getenv("PLAN_MODEL", "gpt-4o-mini")
+
+# how many hints are written per waypoint, each more direct than the last
+HINT_TIERS = int(os.getenv("HINT_TIERS", "2"))
+
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv("PLAN_CONCURRENCY", "8")),
+                               thread_name_prefix="plan")
+
+PLAN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "legs": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "riddle": {"type": "string"},
+                    "hints": {"type": "array", "items": {"type": "string"}},
+                },
+                "required": ["riddle", "hints"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["legs"],
+    "additionalProperties": False,
+}
+
+
+def legs(origin_id: str, waypoints: List[Dict]) -> List[Tuple[str, str]]:
+    """Returns the (start, end) place ids of the legs that get a riddle.
+
+    The game is over once the second to last waypoint is reached, so the
+    last waypoint never gets one.
+    """
+    place_ids = [origin_id] + [place["place_id"] for place in waypoints]
+    return list(zip(place_ids, place_ids[1:]))[:max(len(waypoints) - 1, 1)]
+
+
+def _leg(api_key: str, start: str, end: str) -> Dict:
+    maps = get_maps_client(api_key)
+    directions = get_directions(api_key, start, end)
+    routes = directions.get("routes")
+    return {
+        "start": maps.place_details(start).get("name"),
+        "end": maps.place_details(end).get("name"),
+        "sights": get_notable_sights(api_key, routes[0]) if routes else [],
+        "details": maps.place_details(end),
+    }
+
+
+@timed("plan_game")
+def plan_game(api_key: str, origin_id: str, waypoints: List[Dict]) -> Optional[Dict]:
+    """Writes the riddles and hints of a whole game with one completion.
+
+    The routes and sights of all legs are collected concurrently and put
+    into a single structured output prompt.
+
+    Args:
+        api_key (str): The Google Maps API key.
+        origin_id (str): The place id of where the player starts.
+        waypoints (List[Dict]): The waypoints of the game, in order.
+
+    Returns:
+        {"riddles": [...], "hints": [[...], ...]} with the riddle and the
+        hints of every leg, or None if the plan could not be made, in which
+        case the riddles and hints are written one by one.
+    """
+    pairs = legs(origin_id, waypoints)
+    try:
+        collected = list(_executor.map(propagate(lambda pair: _leg(api_key, *pair)), pairs))
+    except Exception:
+        logger.warning("Collecting the legs of a game plan failed", exc_info=True)
+        count("game_plans", result="error")
+        return None
+
+    def validate(answer: Dict) -> bool:
+        plan_legs = answer.get("legs") if isinstance(answer, dict) else None
+        if not isinstance(plan_legs, list) or len(plan_legs) != len(collected):
+            return False
+        for leg, plan_leg in zip(collected, plan_legs):
+            if not isinstance(plan_leg, dict):
+                return False
+            riddle, hints = plan_leg.get("riddle"), plan_leg.get("hints")
+            if not isinstance(riddle, str) or not riddle.strip():
+                return False
+            # the riddle must not give the answer away
+            if leg["end"] and leg["end"].lower() in riddle.lower():
+                return False
+            if not isinstance(hints, list) or not hints or not all(isinstance(h, str) and h.strip() for h in hints):
+                return False
+        return True
+
+    prompt, _ = game_plan_prompt(collected, HINT_TIERS)
+    try:
+        answer = complete_json(prompt, PLAN_SCHEMA, "game_plan", model=PLAN_MODEL, validate=validate)
+    except Exception:
+        logger.warning("The game plan completion failed", exc_info=True)
+        count("game_plans", result="error")
+        return None
+    count("game_plans", result="invalid" if answer is None else "ok")
+    if answer is None:
+        return None
+    return {
+        "riddles": [leg["riddle"].strip() for leg in answer["legs"]],
+        "hints": [[hint.strip() for hint in leg["hints"][:HINT_TIERS]] for leg in answer["legs"]],
+    }
@@ -1,138 +1,53 @@
-import requests  
-from openai import OpenAI
 import json
 import os
 
+from functions.llm import complete, recall_latest, remember_latest
+from functions.progress import report
+from functions.maps import get_maps_client
+from functions.metrics import count, timed
+from functions.prompts import riddle_prompt
+from functions.scheduler import scheduler
+from functions.sights import collect_sights
+
   
+@timed("directions")
 def get_directions(api_key, start, end):  
     # start and end are place ids
-    directions_url = "https://maps.googleapis.com/maps/api/directions/json"  
-    params = {
-        'origin': f'place_id:{start}',
-        'destination': f'place_id:{end}',
-        'key': api_key
-    }
-      
-    response = requests.get(directions_url, params=params)  
-    directions = response.json()  
-    return directions  
+    return get_maps_client(api_key).directions(start, end)
   
 def get_notable_sights(api_key, path):  
-    places_url = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"  
-    notable_sights = []  
-      
-    # Extract points from the path  
-    points = [step['end_location'] for step in path['legs'][0]['steps']]  
-    
-    # specify such included types that will make sense to be used to generate a 
-    # riddle. for example, the "route" type is not included because it is not
-    # a place thatthat make for a good riddle fodder.
-    included_types = [
-        "amusement_park",
-        "aquarium",
-        "art_gallery",
-        "bakery",
-        "bar",
-        "book_store",
-        "cafe",
-        "campground",
-        "church",
-        "hindu_temple",
-        "mosque",
-        "city_hall",
-        "clothing_store",
-        "convenience_store",
-        "department_store",
-        "electronics_store",
-        "florist",
-        "furniture_store",
-        "grocery_or_supermarket",
-        "hardware_store",
-        "home_goods_store",
-        "jewelry_store",
-        "liquor_store",
-        "meal_delivery",
-        "meal_takeaway",
-        "movie_theater",
-        "museum",
-        "night_club",
-        "park",
-        "restaurant",
-        "shopping_mall",
-        "spa",
-        "store",
-        "zoo",
-        "route",
-        "political",
-        "point_of_interest",
-    ]
-      
-    for point in points:  
-        params = {  
-            'location': f"{point['lat']},{point['lng']}",  
-            'radius': 10,  
-            'key': api_key,  
-            # 'type': "|".join(included_types)
-        }
-          
-        response = requests.get(places_url, params=params)  
-        results = response.json().get('results', [])  
-          
-        for place in results:  
-            notable_sights.append({  
-                'name': place.get('name'),  
-                'location': place.get('geometry', {}).get('location')  
-            })
-      
-    return notable_sights  
+    # sample the route instead of searching around every single step
+    return collect_sights(api_key, path)
   
+@timed("generate_riddle")
 def generate_riddle(api_key, start, end):  
+    # while the quotas are congested, a riddle that already leads to the
+    # destination beats waiting for a new one
+    if scheduler.congested("openai") or scheduler.congested("maps"):
+        riddle = recall_latest("riddle", end)
+        if riddle is not None:
+            count("degraded", stage="riddle")
+            return riddle
+
     # Get directions and notable sights
+    report("building route")
     directions = get_directions(api_key, start, end)  
-    notable_sights = get_notable_sights(api_key, directions['routes'][0])  
+    report("looking for sights")
+    # without a route the riddle is built from the destination alone
+    routes = directions.get('routes')
+    notable_sights = get_notable_sights(api_key, routes[0]) if routes else []
     # Generate a riddle based on the notable sights  
     # get the place details for the start and end points
-    places_url = "https://maps.googleapis.com/maps/api/place/details/json"
-
-    # use only the name key in the notable_sights list
-    notable_sights = [sight['name'] for sight in notable_sights]
-
-    params = {
-        'place_id': start,
-        'key': api_key
-    }
-
-    response = requests.get(places_url, params=params)
-    start_name = response.json().get('result', {}).get('name')
-
-    params = {
-        'place_id': end,
-        'key': api_key
-    }
-
-    response = requests.get(places_url, params=params)
-    end_name = response.json().get('result', {}).get('name')
+    maps = get_maps_client(api_key)
 
-    prompt = (
-        "You have a list of some notable points that lie in a path leading to some destination. "
-        "Build a riddle that uses some of these points (the ones you think are best suited to be used) as "
-        "clues to the destination. The riddle should be such that the answer to the riddle is the destination. "
-        "Don't mention the destination name in the riddle. "
-        f"The start location is {start_name} and more importantly, the destination is {end_name}. "
-        f"The notable points are as follows: {notable_sights}."
-        "Only output the riddle and nothing else."
-    )
-    
-    openai_client = OpenAI(api_key="")
+    start_name = maps.place_details(start).get('name')
+    end_name = maps.place_details(end).get('name')
 
-    response = openai_client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant."},
-            {"role": "user", "content": prompt},
-        ]
-    )
+    # only the most salient sights that fit the token budget are used
+    prompt, _ = riddle_prompt(start_name, end_name, notable_sights)
 
-    riddle = response.choices[0].message.content
+    report("writing riddle")
+    riddle = complete(prompt, stream=True)
+    remember_latest("riddle", end, riddle)
     # TODO generate image and voice over to the riddle
     return riddle
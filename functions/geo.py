@@ -0,0 +1,60 @@
+import math
+from typing import Tuple
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def haversine(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Returns the great circle distance between two points in metres."""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(a))
+
+
+def parse_lat_lng(value: str) -> Tuple[float, float]:
+    """Parses a "lat,lng" string into a pair of floats."""
+    lat, lng = value.split(",")
+    return float(lat), float(lng)
+
+
+_GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# approximate geohash cell heights in metres, by precision
+_GEOHASH_CELL_M = {5: 4900, 6: 610, 7: 153, 8: 19, 9: 4.8}
+
+
+def geohash(lat: float, lng: float, precision: int = 7) -> str:
+    """Encodes a point as a geohash of ``precision`` characters."""
+    lat_range = [-90.0, 90.0]
+    lng_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        interval, coordinate = (lng_range, lng) if even else (lat_range, lat)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coordinate >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_GEOHASH_ALPHABET[value])
+            bits = 0
+            value = 0
+    return "".join(chars)
+
+
+def geohash_precision(radius: float) -> int:
+    """Returns the coarsest geohash precision whose cells are small next to ``radius``."""
+    for precision in sorted(_GEOHASH_CELL_M):
+        if _GEOHASH_CELL_M[precision] <= radius / 4:
+            return precision
+    return max(_GEOHASH_CELL_M)
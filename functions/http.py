@@ -0,0 +1,311 @@
+import os
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from logging import getLogger
+from typing import Dict, Optional, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from functions.metrics import span
+from functions.scheduler import scheduler
+
+logger = getLogger(__name__)
+
+# the number of keep-alive connections kept open per host
+POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))
+# the threads that send hedgeable requests, so that a caller can give up on
+# a slow attempt; requests that find them all busy are sent unhedged from
+# the calling thread instead of waiting for one
+HEDGE_POOL_SIZE = int(os.getenv("HEDGE_POOL_SIZE", "32"))
+
+# seconds to wait for a response, by endpoint
+TIMEOUTS = {
+    "directions": 10.0,
+    "distancematrix": 10.0,
+    "nearbysearch": 5.0,
+    "details": 5.0,
+    "photo": 10.0,
+}
+DEFAULT_TIMEOUT = 10.0
+
+# seconds after which a second, identical request is sent if the first one
+# hasn't answered yet
+HEDGE_DELAYS = {
+    "nearbysearch": float(os.getenv("HEDGE_DELAY_NEARBYSEARCH", "1.0")),
+    "details": float(os.getenv("HEDGE_DELAY_DETAILS", "1.0")),
+}
+
+RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+BACKOFF_SECONDS = 0.2
+
+# responses that are worth retrying
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+RETRY_API_STATUSES = {"OVER_QUERY_LIMIT", "UNKNOWN_ERROR"}
+
+# errors that mean the API key is over its quota
+QUOTA_ERRORS = {"HTTP 429", "OVER_QUERY_LIMIT"}
+
+_session = None
+_transport = None
+
+
+def get_session() -> requests.Session:
+    """Returns the process wide session so that connections are reused."""
+    global _session
+    if _session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _session = session
+    return _session
+
+
+class TransientError(Exception):
+    """A request failed in a way that may succeed when retried."""
+
+
+class CircuitOpenError(Exception):
+    """An endpoint failed too often and is not called for a while."""
+
+
+class CircuitBreaker:
+    """Stops calling an endpoint after ``threshold`` failures in a row.
+
+    After ``reset_after`` seconds a single trial request is let through,
+    and the circuit closes again if it succeeds. The trial ends when the
+    request that got it calls `release`, however it went.
+    """
+
+    def __init__(self, threshold: int = 5, reset_after: float = 30.0):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_after:
+            return "half-open"
+        return "open"
+
+    def allow(self) -> Optional[str]:
+        """Returns None if a request may not be sent, else "trial" if it is the
+        trial of a half-open circuit and "closed" otherwise."""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return "closed"
+            if state == "half-open" and not self._trial_running:
+                self._trial_running = True
+                return "trial"
+            return None
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def release(self, permit: Optional[str]):
+        """Ends the trial if ``permit``, what `allow` returned, is the trial."""
+        if permit != "trial":
+            return
+        with self._lock:
+            self._trial_running = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+
+
+class EndpointStats:
+    """Counts calls and keeps the most recent latencies of an endpoint."""
+
+    def __init__(self, window: int = 1000):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.hedges = 0
+        self.rejected = 0
+        self.latencies = deque(maxlen=window)
+
+    def to_dict(self) -> Dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 4)
+
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "rejected": self.rejected,
+            "p50": percentile(0.50),
+            "p95": percentile(0.95),
+            "p99": percentile(0.99),
+        }
+
+
+class Transport:
+    """Sends GET requests with timeouts, retries, hedging and circuit breakers.
+
+    Every endpoint has its own timeout, hedge delay, circuit breaker and
+    stats. Failed requests are retried with exponential backoff and full
+    jitter.
+    """
+
+    def __init__(self, session: requests.Session, retries: int = RETRIES):
+        self.session = session
+        self.retries = retries
+        self._breakers: Dict[str, CircuitBreaker] = defaultdict(CircuitBreaker)
+        self._stats: Dict[str, EndpointStats] = defaultdict(EndpointStats)
+        self._hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_POOL_SIZE, thread_name_prefix="hedge")
+        self._hedge_busy = 0
+        self._unhedged = 0
+        self._hedge_lock = threading.Lock()
+
+    def get(self, endpoint: str, url: str, params: Dict, timeout: Optional[float] = None,
+            raw: bool = False, rate_key: Optional[Tuple[str, str]] = None) -> Union[Dict, bytes]:
+        """Returns the JSON body of a GET request, or the bytes of the body if ``raw``.
+
+        Every attempt waits for its turn with the scheduler under the
+        (provider, API key) ``rate_key``, if one is given.
+
+        Raises:
+            CircuitOpenError: The endpoint's circuit is open.
+            RateLimitedError: An attempt waited too long for its turn.
+            TransientError, requests.RequestException: All attempts failed.
+        """
+        breaker = self._breakers[endpoint]
+        stats = self._stats[endpoint]
+        permit = breaker.allow()
+        if permit is None:
+            stats.rejected += 1
+            raise CircuitOpenError(endpoint)
+
+        timeout = timeout or TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+        try:
+            with span(f"http.{endpoint}"):
+                return self._get(endpoint, url, params, timeout, raw, rate_key)
+        finally:
+            # a half-open circuit must not wait forever for a trial that was
+            # rate limited or failed in an unexpected way, and only the trial
+            # may end it
+            breaker.release(permit)
+
+    def _get(self, endpoint: str, url: str, params: Dict, timeout: float, raw: bool = False,
+             rate_key: Optional[Tuple[str, str]] = None) -> Union[Dict, bytes]:
+        breaker = self._breakers[endpoint]
+        stats = self._stats[endpoint]
+        for attempt in range(self.retries + 1):
+            if attempt:
+                stats.retries += 1
+                time.sleep(random.uniform(0, BACKOFF_SECONDS * 2 ** attempt))
+            if rate_key is not None:
+                scheduler.acquire(*rate_key)
+            started = time.perf_counter()
+            stats.calls += 1
+            try:
+                data = self._send(endpoint, url, params, timeout, raw, rate_key)
+            except (TransientError, requests.RequestException) as e:
+                stats.errors += 1
+                error = e
+                if rate_key is not None and str(e) in QUOTA_ERRORS:
+                    scheduler.throttle(*rate_key)
+                logger.warning("Request to %s failed (attempt %d): %s", endpoint, attempt + 1, e)
+                continue
+            stats.latencies.append(time.perf_counter() - started)
+            breaker.success()
+            return data
+
+        breaker.failure()
+        raise error
+
+    def _send(self, endpoint: str, url: str, params: Dict, timeout: float, raw: bool = False,
+              rate_key: Optional[Tuple[str, str]] = None) -> Union[Dict, bytes]:
+        hedge_delay = HEDGE_DELAYS.get(endpoint)
+        if hedge_delay is None or hedge_delay >= timeout:
+            return self._request(url, params, timeout, raw)
+
+        first = self._submit(url, params, timeout, raw)
+        if first is None:
+            with self._hedge_lock:
+                self._unhedged += 1
+            return self._request(url, params, timeout, raw)
+        done, _ = wait([first], timeout=hedge_delay)
+        # a hedge is only worth it while there is quota to spare
+        if done or (rate_key is not None and not scheduler.try_acquire(*rate_key)):
+            return first.result()
+
+        hedge = self._submit(url, params, timeout, raw)
+        if hedge is None:
+            with self._hedge_lock:
+                self._unhedged += 1
+            return first.result()
+        self._stats[endpoint].hedges += 1
+        pending = {first, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def _submit(self, url: str, params: Dict, timeout: float, raw: bool) -> Optional[Future]:
+        """Sends a request from the hedge pool, or returns None if all its threads are busy."""
+        with self._hedge_lock:
+            if self._hedge_busy >= HEDGE_POOL_SIZE:
+                return None
+            self._hedge_busy += 1
+        return self._hedge_executor.submit(self._pooled_request, url, params, timeout, raw)
+
+    def _pooled_request(self, url: str, params: Dict, timeout: float, raw: bool) -> Union[Dict, bytes]:
+        try:
+            return self._request(url, params, timeout, raw)
+        finally:
+            with self._hedge_lock:
+                self._hedge_busy -= 1
+
+    def _request(self, url: str, params: Dict, timeout: float, raw: bool = False) -> Union[Dict, bytes]:
+        response = self.session.get(url, params=params, timeout=timeout)
+        if response.status_code in RETRY_STATUS_CODES:
+            raise TransientError(f"HTTP {response.status_code}")
+        response.raise_for_status()
+        if raw:
+            return response.content
+        data = response.json()
+        if data.get("status") in RETRY_API_STATUSES:
+            raise TransientError(data["status"])
+        return data
+
+    def stats(self) -> Dict[str, Dict]:
+        return {
+            endpoint: dict(stats.to_dict(), circuit=self._breakers[endpoint].state)
+            for endpoint, stats in sorted(self._stats.items())
+        }
+
+    def hedge_pool_stats(self) -> Dict:
+        return {"size": HEDGE_POOL_SIZE, "busy": self._hedge_busy, "unhedged": self._unhedged}
+
+
+def get_transport() -> Transport:
+    """Returns the transport shared by all outbound HTTP calls."""
+    global _transport
+    if _transport is None:
+        _transport = Transport(get_session())
+    return _transport
@@ -0,0 +1,178 @@
+"""Checks the photos players take against the places they are looking for.
+
+Uploads are decoded, downscaled and re-encoded in a thread pool and reduced
+to a 64 bit perceptual hash. A perceptual hash only recognizes copies of
+the same picture, not other pictures of the same place, so it is used to
+reject copies of the place's own photos, which are cached, and to reuse the
+verdict on a photo uploaded again. Every other photo goes to the vision
+model.
+"""
+import io
+import os
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from functions.llm import complete_with_image
+from functions.maps import get_cache, get_maps_client
+from functions.metrics import count, timed
+
+logger = getLogger(__name__)
+
+# uploads are downscaled to fit a square of this size before anything else
+MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "512"))
+
+# hashes at most this many bits apart belong to copies of the same picture.
+# photos of the same place taken by somebody else are about as far apart
+# as unrelated ones
+COPY_DISTANCE = int(os.getenv("IMAGE_COPY_DISTANCE", "6"))
+
+# whether photos the hashes can't decide on are shown to a vision model
+MODEL_CHECK = os.getenv("IMAGE_MODEL_CHECK", "1") == "1"
+MODEL = os.getenv("IMAGE_MODEL", "gpt-4o-mini")
+
+# how many of a place's photos are compared with an upload
+REFERENCE_PHOTOS = int(os.getenv("IMAGE_REFERENCE_PHOTOS", "3"))
+
+# how long the hashes of a place's photos are kept, in seconds
+HASH_TTL = 30 * 24 * 3600
+
+# how many verdicts on uploads are kept per place, and for how many places
+VERDICTS_PER_PLACE = 32
+MAX_VERDICT_PLACES = 1024
+
+# place id -> (upload hash, verdict), least recently used place first
+_verdicts: "OrderedDict[str, deque]" = OrderedDict()
+_verdicts_lock = threading.Lock()
+
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv("IMAGE_WORKERS", "4")), thread_name_prefix="images")
+
+# the 32 point DCT-II basis, the hash keeps the lowest 8 x 8 frequencies
+_DCT = np.cos(np.pi * np.outer(np.arange(32), 2 * np.arange(32) + 1) / 64)
+
+
+def phash(image: Image.Image) -> int:
+    """Returns the 64 bit DCT perceptual hash of an image."""
+    pixels = np.asarray(image.convert("L").resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    low = (_DCT @ pixels @ _DCT.T)[:8, :8].flatten()
+    # the DC term only says how bright the image is
+    bits = low > np.median(low[1:])
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def prepare(data: bytes) -> Tuple[bytes, int]:
+    """Decodes an upload, downscales it and returns it as a JPEG with its hash.
+
+    Raises:
+        ValueError: The data is not an image.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        # JPEGs can be decoded at a fraction of their size right away
+        image.draft("RGB", (MAX_SIDE, MAX_SIDE))
+        image = ImageOps.exif_transpose(image).convert("RGB")
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ValueError("not an image") from e
+    image.thumbnail((MAX_SIDE, MAX_SIDE))
+    encoded = io.BytesIO()
+    image.save(encoded, format="JPEG", quality=80)
+    return encoded.getvalue(), phash(image)
+
+
+def _photo_hash(photo_reference: str) -> Optional[int]:
+    data = get_maps_client().place_photo(photo_reference)
+    if data is None:
+        return None
+    try:
+        return phash(Image.open(io.BytesIO(data)))
+    except OSError:
+        logger.warning("The photo %s is not an image", photo_reference)
+        return None
+
+
+def reference_hashes(place_id: str) -> List[int]:
+    """Returns the hashes of a place's photos, fetching them only once."""
+    cache = get_cache()
+    cached = cache.get("photo_hash", place_id)
+    if cached is not None:
+        return [int(value, 16) for value in cached]
+
+    photos = get_maps_client().place_details(place_id).get("photos", [])[:REFERENCE_PHOTOS]
+    hashes = [
+        value for value in _executor.map(_photo_hash, [photo["photo_reference"] for photo in photos])
+        if value is not None
+    ]
+    if hashes:
+        cache.put("photo_hash", place_id, [f"{value:016x}" for value in hashes], HASH_TTL)
+    return hashes
+
+
+def _known_verdict(place_id: str, upload_hash: int) -> Optional[bool]:
+    with _verdicts_lock:
+        verdicts = _verdicts.get(place_id, ())
+        for value, verdict in verdicts:
+            if hamming(upload_hash, value) <= COPY_DISTANCE:
+                _verdicts.move_to_end(place_id)
+                return verdict
+    return None
+
+
+def _remember_verdict(place_id: str, upload_hash: int, verdict: bool):
+    with _verdicts_lock:
+        verdicts = _verdicts.get(place_id)
+        if verdicts is None:
+            verdicts = _verdicts[place_id] = deque(maxlen=VERDICTS_PER_PLACE)
+        verdicts.append((upload_hash, verdict))
+        _verdicts.move_to_end(place_id)
+        while len(_verdicts) > MAX_VERDICT_PLACES:
+            _verdicts.popitem(last=False)
+
+
+@timed("check_image")
+def check_image(data: bytes, place: Dict) -> bool:
+    """Tells whether a photo shows a place.
+
+    The upload is prepared while the place's reference hashes are looked up.
+
+    Args:
+        data (bytes): The uploaded image.
+        place (Dict): The waypoint, with its "name" and "place_id".
+    """
+    prepared = _executor.submit(prepare, data)
+    references = reference_hashes(place["place_id"])
+    try:
+        jpeg, upload_hash = prepared.result()
+    except ValueError:
+        count("image_checks", result="invalid")
+        return False
+
+    # the place's own photo, e.g. saved from the maps app, proves nothing
+    if any(hamming(upload_hash, value) <= COPY_DISTANCE for value in references):
+        count("image_checks", result="reference_copy")
+        return False
+    known = _known_verdict(place["place_id"], upload_hash)
+    if known is not None:
+        count("image_checks", result="repeated")
+        return known
+    if not MODEL_CHECK:
+        count("image_checks", result="unchecked")
+        return False
+
+    answer = complete_with_image(
+        f"Does this photo show {place['name']}, or something right next to it? Answer only yes or no.",
+        jpeg,
+        model=MODEL,
+    )
+    matched = answer.strip().lower().startswith("yes")
+    _remember_verdict(place["place_id"], upload_hash, matched)
+    count("image_checks", result="model_match" if matched else "model_reject")
+    return matched
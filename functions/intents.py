@@ -0,0 +1,158 @@
+"""Routes player messages straight to the game functions when their intent is clear.
+
+Picking the tool is the only thing the agent does for most messages, and a
+chat turn costs far more than the tool itself. Requests that name their
+intent, and free text that a few keyword rules classify without doubt, are
+dispatched locally. Anything the rules can't tell apart goes to the agent.
+"""
+import os
+import re
+from collections import Counter
+from typing import Callable, Dict, Optional, Tuple
+
+from functions.geo import parse_lat_lng
+from functions.metrics import count
+
+# whether clear requests skip the agent
+INTENT_ROUTER = os.getenv("INTENT_ROUTER", "1") == "1"
+
+TOOLS = ("start_game", "verify", "get_hint")
+
+START_WORDS = re.compile(r"\b(start|play|new game|begin|interested in|interests?)\b", re.I)
+HINT_WORDS = re.compile(r"\b(hints?|clues?|stuck|help)\b", re.I)
+# only words that claim the target was found, "is it ...?" or "here" are too vague
+VERIFY_WORDS = re.compile(r"\b(found it|found the|reached|arrived|made it|i am at|i'm at)\b", re.I)
+# "I'm not interested in this one" or "I haven't found it" are for the agent
+NEGATIONS = re.compile(r"(\b(not|no|never|cannot|give up)\b|n't\b|\bcant\b|\bdont\b)", re.I)
+
+# GPS fixes always have decimals, which keeps counts like "2, 3" out
+COORDINATES = re.compile(r"(-?\d{1,2}\.\d+)\s*,\s*(-?\d{1,3}\.\d+)")
+# the dict the Streamlit geolocation component gives, pasted into the text
+GEOLOCATION = re.compile(
+    r"['\"]?latitude['\"]?\s*:\s*(-?\d+(?:\.\d+)?).*?['\"]?longitude['\"]?\s*:\s*(-?\d+(?:\.\d+)?)", re.I | re.S
+)
+# the interests run up to where the location is mentioned or the sentence ends
+INTERESTS = re.compile(
+    r"interest(?:ed|s)?\s*(?:in|are|is|:)\s*(.+?)"
+    r"(?=\s*,?\s*(?:and\s+)?(?:my\s+)?(?:current\s+)?location\b|[.!?]|$)",
+    re.I,
+)
+
+# how many requests went which way since the start, for /stats
+routes: Counter = Counter()
+
+
+def find_location(text: str) -> Optional[Tuple[str, Tuple[int, int]]]:
+    """Returns the "lat,lng" mentioned in a text and where it is, None if there is none."""
+    match = GEOLOCATION.search(text) or COORDINATES.search(text)
+    if match is None:
+        return None
+    lat, lng = float(match.group(1)), float(match.group(2))
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+    return f"{lat},{lng}", match.span()
+
+
+def classify(text: str) -> Optional[Tuple[str, Dict]]:
+    """Picks the tool and its arguments for a free text message.
+
+    Returns None unless exactly one intent is clear and all of its
+    arguments are in the text. Negated messages always go to the agent, and
+    answers have to claim the target was found or be nothing but a location.
+    """
+    found = find_location(text)
+    location, (begin, end) = found if found else (None, (0, 0))
+    rest = text[:begin] + text[end:]
+    if NEGATIONS.search(rest):
+        return None
+    start, hint, verify = START_WORDS.search(rest), HINT_WORDS.search(rest), VERIFY_WORDS.search(rest)
+
+    if hint:
+        # asking for a hint while starting a game or answering is ambiguous
+        return ("get_hint", {}) if not start and not verify else None
+    if start:
+        interests = INTERESTS.search(rest)
+        if location is None or interests is None or not interests.group(1).strip(" ,"):
+            # the agent asks for what is missing
+            return None
+        return "start_game", {"current_location": location, "user_interests": interests.group(1).strip(" ,")}
+    if location is not None and ((verify and "?" not in rest) or not re.sub(r"[\W_]+", "", rest)):
+        # an answer, or coordinates and nothing else
+        return "verify", {"current_location": location}
+    return None
+
+
+def check_location(location: str):
+    """Raises ValueError unless a location is a "lat,lng" on the globe."""
+    try:
+        lat, lng = parse_lat_lng(location)
+    except ValueError:
+        raise ValueError(f'The location has to be "lat,lng", not {location!r}')
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        raise ValueError(f"The location {location} is not on the globe")
+
+
+def route(data: str, intent: Optional[str] = None, location: Optional[str] = None,
+          interests: Optional[str] = None,
+          game_active: Callable[[], bool] = lambda: False) -> Optional[Tuple[str, Dict]]:
+    """Decides which tool answers a request without asking the agent.
+
+    A new game replaces the one in progress, so the rules only start one
+    when the player has none.
+
+    Args:
+        data (str): The player's message.
+        intent (str): The tool the client asks for, if it knows.
+        location (str): The player's "lat,lng", if the client sends it apart
+            from the message.
+        interests (str): The player's interests, likewise.
+        game_active (Callable[[], bool]): Tells whether the player has a game
+            in progress, only asked before starting a game by rule.
+
+    Returns:
+        The tool name and its arguments, or None if the agent has to decide.
+
+    Raises:
+        ValueError: The intent is unknown or lacks its arguments, or the
+            location is not a valid "lat,lng".
+    """
+    if location:
+        # the client's location replaces the one in the text, so it has to
+        # be valid whichever way the request goes
+        check_location(location)
+    if intent is not None:
+        if intent not in TOOLS:
+            raise ValueError(f"Unknown intent {intent}")
+        if intent != "get_hint":
+            if not location:
+                raise ValueError(f"{intent} needs a location")
+        if intent == "start_game" and not interests:
+            raise ValueError("start_game needs the interests")
+        params = {"get_hint": {}, "verify": {"current_location": location}}.get(
+            intent, {"current_location": location, "user_interests": interests}
+        )
+        return _count(intent, "fields", params)
+
+    routed = classify(data) if INTENT_ROUTER else None
+    if routed is None or (routed[0] == "start_game" and game_active()):
+        return _count("agent", "agent", None)
+    tool, params = routed
+    if location and "current_location" in params:
+        # the location the client measured beats the one in the text
+        params["current_location"] = location
+    return _count(tool, "rules", params)
+
+
+def _count(tool: str, source: str, params: Optional[Dict]) -> Optional[Tuple[str, Dict]]:
+    routes[source] += 1
+    count("intent_routes", tool=tool, source=source)
+    return None if params is None else (tool, params)
+
+
+def stats() -> Dict:
+    total = sum(routes.values())
+    return {
+        "requests": total,
+        "by_source": dict(routes),
+        "hit_rate": round((total - routes["agent"]) / total, 3) if total else None,
+    }
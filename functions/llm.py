@@ -0,0 +1,352 @@
+import base64
+import hashlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+from logging import getLogger
+from typing import TYPE_CHECKING, Callable, Dict, FrozenSet, List, Optional, Tuple
+
+from functions import progress
+from functions.cache import ResponseCache
+from functions.coalesce import SingleFlight
+from functions.metrics import count, span
+from functions.scheduler import scheduler
+
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+logger = getLogger(__name__)
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+SYSTEM_PROMPT = "You are a helpful assistant."
+
+# how long completions are kept in the persistent tier, in seconds
+COMPLETION_TTL_SECONDS = int(os.getenv("COMPLETION_TTL_SECONDS", str(7 * 24 * 3600)))
+
+# how often a failed completion request is retried, each time waiting for
+# its turn with the scheduler again
+RETRIES = int(os.getenv("OPENAI_RETRIES", "2"))
+BACKOFF_SECONDS = 0.5
+
+# responses that are worth retrying
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+_client = None
+_cache = None
+# identical prompts asked for at the same time share one request
+_flight = SingleFlight()
+
+
+def get_openai_client() -> "OpenAI":
+    """Returns the OpenAI client shared by the whole process.
+
+    The SDK is only imported here, since importing it is slow. Its own
+    retries are off, they would go around the rate limits.
+    """
+    global _client
+    if _client is None:
+        from openai import OpenAI
+
+        _client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
+    return _client
+
+
+def _create(**kwargs):
+    """Sends a chat completion request as soon as the rate limits allow it.
+
+    Failed requests are retried with exponential backoff and full jitter,
+    and every attempt waits for its turn with the scheduler.
+    """
+    from openai import APIConnectionError
+
+    client = get_openai_client()
+    for attempt in range(RETRIES + 1):
+        if attempt:
+            time.sleep(random.uniform(0, BACKOFF_SECONDS * 2 ** attempt))
+        scheduler.acquire("openai", client.api_key)
+        try:
+            return client.chat.completions.create(**kwargs)
+        except Exception as e:
+            status_code = getattr(e, "status_code", None)
+            if status_code == 429:
+                # the other calls back off too
+                scheduler.throttle("openai", client.api_key)
+            retryable = status_code in RETRY_STATUS_CODES or isinstance(e, APIConnectionError)
+            if not retryable or attempt == RETRIES:
+                raise
+            logger.warning("Completion request failed (attempt %d): %s", attempt + 1, e)
+
+
+class CompletionCache:
+    """Caches completions in an in-memory LRU in front of a persistent store."""
+
+    def __init__(self, store: ResponseCache, max_memory_entries: int = 2048,
+                 ttl: int = COMPLETION_TTL_SECONDS):
+        self.store = store
+        self.max_memory_entries = max_memory_entries
+        self.ttl = ttl
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(model: str, prompt: str, temperature: Optional[float]) -> str:
+        prompt_hash = hashlib.sha256(prompt.encode()).hexdigest()
+        return f"{model}:{prompt_hash}:{temperature}"
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        value = self.store.get("completion", key)
+        if value is not None:
+            self._remember(key, value)
+        return value
+
+    def put(self, key: str, value: str):
+        self._remember(key, value)
+        self.store.put("completion", key, value, self.ttl)
+
+    def _remember(self, key: str, value: str):
+        with self._lock:
+            self._memory[key] = value
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+
+
+def get_completion_cache() -> CompletionCache:
+    """Returns the completion cache stored in ``COMPLETION_CACHE_DB``."""
+    global _cache
+    if _cache is None:
+        _cache = CompletionCache(ResponseCache(os.getenv("COMPLETION_CACHE_DB", "completion_cache.db")))
+    return _cache
+
+
+def complete(prompt: str, model: str = DEFAULT_MODEL, temperature: Optional[float] = None,
+             use_cache: bool = True, stream: bool = False) -> str:
+    """Runs a chat completion for a single user prompt.
+
+    Args:
+        prompt (str): The user prompt.
+        model (str): The OpenAI model to use.
+        temperature (float): The sampling temperature, None for the API default.
+        use_cache (bool): Whether identical requests may be answered from the cache.
+        stream (bool): Whether the text is for the player, and is streamed as
+            ``token`` events while a progress listener is active.
+
+    Concurrent calls with the same cached prompt share one request.
+    """
+    cache = get_completion_cache()
+    key = cache.key(model, prompt, temperature)
+    if use_cache:
+        cached = cache.get(key)
+        count("llm_cache", result="hit" if cached is not None else "miss")
+        if cached is not None:
+            if stream:
+                progress.emit("token", {"text": cached})
+            return cached
+
+    if not use_cache:
+        return _complete(prompt, model, temperature, stream=stream)
+    led = []
+
+    def lead():
+        led.append(True)
+        return _complete(prompt, model, temperature, key, stream)
+
+    content = _flight.do(key, lead)
+    if stream and not led:
+        # the stream went to the listener of the request that made it
+        progress.emit("token", {"text": content})
+    return content
+
+
+def _complete(prompt: str, model: str, temperature: Optional[float], key: Optional[str] = None,
+              stream: bool = False) -> str:
+    kwargs = {} if temperature is None else {"temperature": temperature}
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+    count("api_calls", provider="openai", endpoint="chat")
+    with span("llm"):
+        if stream and progress.listening():
+            chunks = []
+            for chunk in _create(model=model, messages=messages, stream=True, **kwargs):
+                text = chunk.choices[0].delta.content if chunk.choices else None
+                if text:
+                    chunks.append(text)
+                    progress.emit("token", {"text": text})
+            content = "".join(chunks)
+        else:
+            response = _create(
+                model=model, messages=messages, **kwargs
+            )
+            content = response.choices[0].message.content
+    # an empty answer would be served for the prompt until it expires
+    if key is not None and content:
+        get_completion_cache().put(key, content)
+    return content
+
+
+def complete_json(prompt: str, schema: Dict, name: str, model: str = DEFAULT_MODEL,
+                  validate: Optional[Callable[[Dict], bool]] = None, use_cache: bool = True) -> Optional[Dict]:
+    """Runs a chat completion whose answer has to follow a JSON schema.
+
+    Args:
+        prompt (str): The user prompt.
+        schema (Dict): The JSON schema of the answer, in the strict structured output subset.
+        name (str): The name of the schema.
+        model (str): The OpenAI model to use, it has to support structured outputs.
+        validate (Callable[[Dict], bool]): Further checks the parsed answer has to pass.
+        use_cache (bool): Whether identical requests may be answered from the cache.
+
+    Returns:
+        The parsed answer, or None if it is not valid JSON or fails ``validate``.
+        Invalid answers are not cached.
+    """
+    cache = get_completion_cache()
+    key = cache.key(model, prompt + json.dumps(schema, sort_keys=True), None)
+    if use_cache:
+        cached = cache.get(key)
+        count("llm_cache", result="hit" if cached is not None else "miss")
+        if cached is not None:
+            return json.loads(cached)
+
+    if not use_cache:
+        return _complete_json(prompt, schema, name, model, validate)
+    return _flight.do(key, _complete_json, prompt, schema, name, model, validate, key)
+
+
+def _complete_json(prompt: str, schema: Dict, name: str, model: str,
+                   validate: Optional[Callable[[Dict], bool]], key: Optional[str] = None) -> Optional[Dict]:
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt},
+    ]
+    response_format = {
+        "type": "json_schema",
+        "json_schema": {"name": name, "schema": schema, "strict": True},
+    }
+    count("api_calls", provider="openai", endpoint="chat")
+    with span("llm"):
+        response = _create(
+            model=model, messages=messages, response_format=response_format
+        )
+    content = response.choices[0].message.content
+    try:
+        answer = json.loads(content)
+    except (TypeError, ValueError):
+        logger.warning("The %s answer is not valid JSON", name)
+        return None
+    if validate is not None and not validate(answer):
+        logger.warning("The %s answer failed validation", name)
+        return None
+    if key is not None and answer:
+        get_completion_cache().put(key, content)
+    return answer
+
+
+def complete_with_image(prompt: str, image: bytes, model: str = "gpt-4o-mini", use_cache: bool = True) -> str:
+    """Runs a chat completion for a prompt about a JPEG image.
+
+    Args:
+        prompt (str): The user prompt.
+        image (bytes): The JPEG image, small enough to be sent inline.
+        model (str): The OpenAI model to use, it has to accept images.
+        use_cache (bool): Whether identical requests may be answered from the cache.
+    """
+    cache = get_completion_cache()
+    key = cache.key(model, prompt + hashlib.sha256(image).hexdigest(), None)
+    if use_cache:
+        cached = cache.get(key)
+        count("llm_cache", result="hit" if cached is not None else "miss")
+        if cached is not None:
+            return cached
+
+    image_url = "data:image/jpeg;base64," + base64.b64encode(image).decode()
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": [
+            {"type": "text", "text": prompt},
+            {"type": "image_url", "image_url": {"url": image_url, "detail": "low"}},
+        ]},
+    ]
+    count("api_calls", provider="openai", endpoint="chat")
+    with span("llm"):
+        response = _create(model=model, messages=messages)
+    content = response.choices[0].message.content
+    if use_cache and content:
+        cache.put(key, content)
+    return content
+
+
+def remember_latest(kind: str, key: str, text: str):
+    """Keeps the latest text of a kind for a key, e.g. the riddle leading to a place."""
+    if text:
+        get_completion_cache().store.put(f"latest_{kind}", key, text, COMPLETION_TTL_SECONDS)
+
+
+def recall_latest(kind: str, key: str) -> Optional[str]:
+    """Returns the text kept by `remember_latest`, to fall back on under load."""
+    return get_completion_cache().store.get(f"latest_{kind}", key)
+
+
+# words that carry no meaning when comparing interests
+_STOP_WORDS = {"a", "an", "and", "i", "in", "like", "love", "me", "my", "of", "or", "the", "to", "we"}
+
+
+class SemanticCache:
+    """Matches near-duplicate interest strings.
+
+    Interests are reduced to a set of lower-cased words, and a lookup
+    returns the value stored for the most similar set if its Jaccard
+    similarity is at least ``threshold``.
+    """
+
+    def __init__(self, threshold: float = 0.8, max_entries: int = 1024):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[FrozenSet[str], List[str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def tokens(text: str) -> FrozenSet[str]:
+        return frozenset(word for word in re.findall(r"[a-z0-9]+", text.lower()) if word not in _STOP_WORDS)
+
+    def get(self, text: str) -> Optional[List[str]]:
+        tokens = self.tokens(text)
+        if not tokens:
+            return None
+        best: Tuple[float, Optional[FrozenSet[str]]] = (0.0, None)
+        with self._lock:
+            for candidate in self._entries:
+                similarity = len(tokens & candidate) / len(tokens | candidate)
+                if similarity > best[0]:
+                    best = (similarity, candidate)
+            if best[1] is None or best[0] < self.threshold:
+                return None
+            self._entries.move_to_end(best[1])
+            return self._entries[best[1]]
+
+    def put(self, text: str, value: List[str]):
+        tokens = self.tokens(text)
+        if not tokens:
+            return
+        with self._lock:
+            self._entries[tokens] = value
+            self._entries.move_to_end(tokens)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+# near-duplicate matching of interests is opt-in
+interests_cache: Optional[SemanticCache] = (
+    SemanticCache(float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.8")))
+    if os.getenv("SEMANTIC_CACHE") == "1" else None
+)
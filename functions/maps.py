@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+from logging import getLogger
+from typing import Dict, List, Optional
+
+from requests import RequestException
+
+from functions.cache import ResponseCache
+from functions.coalesce import MicroBatcher, SingleFlight
+from functions.geo import geohash, geohash_precision, parse_lat_lng
+from functions.http import CircuitOpenError, TransientError, get_transport
+from functions.metrics import count
+from functions.scheduler import RateLimitedError
+from functions.tiles import find_nearby
+
+logger = getLogger(__name__)
+
+# can be pointed at a local stub, e.g. for benchmarks
+MAPS_BASE_URL = os.getenv("MAPS_BASE_URL", "https://maps.googleapis.com")
+
+DIRECTIONS_URL = f"{MAPS_BASE_URL}/maps/api/directions/json"
+NEARBY_SEARCH_URL = f"{MAPS_BASE_URL}/maps/api/place/nearbysearch/json"
+PLACE_DETAILS_URL = f"{MAPS_BASE_URL}/maps/api/place/details/json"
+DISTANCE_MATRIX_URL = f"{MAPS_BASE_URL}/maps/api/distancematrix/json"
+PLACE_PHOTO_URL = f"{MAPS_BASE_URL}/maps/api/place/photo"
+
+# how long the responses of each endpoint are cached, in seconds
+CACHE_TTLS = {
+    "directions": 24 * 3600,
+    "nearbysearch": 6 * 3600,
+    "details": 24 * 3600,
+    "distancematrix": 24 * 3600,
+}
+
+# seconds place-details lookups are collected before they are sent
+DETAILS_BATCH_WINDOW = float(os.getenv("DETAILS_BATCH_WINDOW_MS", "5")) / 1000
+
+_cache = None
+_clients: Dict[str, "MapsClient"] = {}
+
+
+def get_cache() -> ResponseCache:
+    """Returns the cache shared by all Maps clients.
+
+    It lives in ``MAPS_CACHE_DB`` (default ``maps_cache.db``) and keeps at
+    most ``MAPS_CACHE_MAX_ENTRIES`` responses.
+    """
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache(
+            os.getenv("MAPS_CACHE_DB", "maps_cache.db"),
+            max_entries=int(os.getenv("MAPS_CACHE_MAX_ENTRIES", "100000")),
+        )
+    return _cache
+
+
+def get_maps_client(api_key: Optional[str] = None) -> "MapsClient":
+    """Returns the shared Maps client for an API key (default ``MAPS_API_KEY``)."""
+    if api_key is None:
+        api_key = os.getenv("MAPS_API_KEY")
+    client = _clients.get(api_key)
+    if client is None:
+        client = _clients[api_key] = MapsClient(api_key, get_cache())
+    return client
+
+
+class MapsClient:
+    """A cached client for the Google Maps endpoints used by the game."""
+
+    def __init__(self, api_key: str, cache: ResponseCache):
+        self.api_key = api_key
+        self.cache = cache
+        self._in_flight = SingleFlight()
+        self._details = MicroBatcher(self._place_details, DETAILS_BATCH_WINDOW)
+
+    def _key(self, endpoint: str, params: Dict) -> str:
+        normalized = dict(params)
+        if "location" in normalized:
+            # nearby coordinates share a cache entry: snap them to a geohash
+            # cell that is small compared to the search radius
+            lat, lng = parse_lat_lng(normalized["location"])
+            precision = geohash_precision(float(normalized.get("radius", 50)))
+            normalized["location"] = geohash(lat, lng, precision)
+        encoded = json.dumps(normalized, sort_keys=True, default=str)
+        return endpoint + ":" + hashlib.sha1(encoded.encode()).hexdigest()
+
+    def _get(self, endpoint: str, url: str, params: Dict, timeout: Optional[float] = None) -> Dict:
+        key = self._key(endpoint, params)
+        cached = self.cache.get(endpoint, key)
+        count("maps_cache", endpoint=endpoint, result="hit" if cached is not None else "miss")
+        if cached is not None:
+            return cached
+        # identical queries that are already in flight share the response
+        return self._in_flight.do(key, self._fetch, endpoint, key, url, params, timeout)
+
+    def _fetch(self, endpoint: str, key: str, url: str, params: Dict, timeout: Optional[float]) -> Dict:
+        count("api_calls", provider="maps", endpoint=endpoint)
+        try:
+            data = get_transport().get(endpoint, url, {**params, "key": self.api_key}, timeout,
+                                       rate_key=("maps", self.api_key))
+        except (CircuitOpenError, RateLimitedError, TransientError, RequestException):
+            # an outdated answer beats no answer while the API is struggling
+            stale = self.cache.get(endpoint, key, allow_stale=True)
+            if stale is not None:
+                logger.warning("Serving a stale %s response", endpoint)
+                return stale
+            logger.warning("%s is unavailable, returning an empty response", endpoint)
+            return {"status": "UNAVAILABLE"}
+
+        # don't remember errors such as REQUEST_DENIED
+        if data.get("status") in ("OK", "ZERO_RESULTS"):
+            self.cache.put(endpoint, key, data, CACHE_TTLS[endpoint])
+        return data
+
+    def directions(self, start: str, end: str) -> Dict:
+        """Returns the walking directions between two place ids."""
+        params = {
+            'origin': f'place_id:{start}',
+            'destination': f'place_id:{end}',
+            'mode': 'walking',
+        }
+        return self._get("directions", DIRECTIONS_URL, params)
+
+    def nearby_search(self, location: str, radius: int, keyword: Optional[str] = None,
+                      timeout: Optional[float] = None) -> List[Dict]:
+        """Returns the places around a "lat,lng" location.
+
+        Locations covered by an offline tile pack are answered locally.
+        """
+        lat, lng = parse_lat_lng(location)
+        local = find_nearby(lat, lng, radius, keyword)
+        count("tile_pack", result="hit" if local is not None else "miss")
+        if local is not None:
+            return local
+
+        params = {"location": location, "radius": radius}
+        if keyword:
+            params["keyword"] = keyword
+        return self._get("nearbysearch", NEARBY_SEARCH_URL, params, timeout).get("results", [])
+
+    def place_details(self, place_id: str) -> Dict:
+        """Returns the details of a place.
+
+        Lookups arriving within DETAILS_BATCH_WINDOW of each other are
+        batched, so every place id is fetched once.
+        """
+        cached = self.cache.get("details", self._key("details", {"place_id": place_id}))
+        count("maps_cache", endpoint="details", result="hit" if cached is not None else "miss")
+        if cached is not None:
+            return cached.get("result", {})
+        return self._details.get(place_id)
+
+    def _place_details(self, place_id: str) -> Dict:
+        # place_details already missed the cache, so the batch goes straight to the API
+        params = {"place_id": place_id}
+        key = self._key("details", params)
+        return self._in_flight.do(key, self._fetch, "details", key, PLACE_DETAILS_URL, params, None).get("result", {})
+
+    def distance_matrix(self, origins: List[str], destinations: List[str]) -> List[Dict]:
+        """Returns the rows of the walking distance matrix between two lists of place ids."""
+        params = {
+            'origins': "|".join(f"place_id:{place_id}" for place_id in origins),
+            'destinations': "|".join(f"place_id:{place_id}" for place_id in destinations),
+            'mode': 'walking',
+        }
+        return self._get("distancematrix", DISTANCE_MATRIX_URL, params).get("rows", [])
+
+    def place_photo(self, photo_reference: str, max_width: int = 400) -> Optional[bytes]:
+        """Returns the image of a place photo, None if it can't be fetched.
+
+        Photos are not cached here, callers keep what they derive from them.
+        """
+        count("api_calls", provider="maps", endpoint="photo")
+        params = {"photo_reference": photo_reference, "maxwidth": max_width, "key": self.api_key}
+        try:
+            return get_transport().get("photo", PLACE_PHOTO_URL, params, raw=True, rate_key=("maps", self.api_key))
+        except (CircuitOpenError, RateLimitedError, TransientError, RequestException):
+            logger.warning("Could not fetch the photo %s", photo_reference)
+            return None
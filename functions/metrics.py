@@ -0,0 +1,189 @@
+import contextvars
+import functools
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Dict, List, Optional, Tuple
+
+from functions import events
+
+# metrics are collected unless METRICS=0
+ENABLED = os.getenv("METRICS", "1") != "0"
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# upper bounds of the buckets of size histograms, e.g. prompt tokens
+SIZE_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class RequestTimings:
+    """The spans and counts recorded while handling one request."""
+
+    def __init__(self):
+        self.spans: List[Tuple[str, float]] = []
+        self.counts: Dict[str, int] = defaultdict(int)
+
+    def server_timing(self) -> str:
+        """Formats the spans for a Server-Timing header."""
+        totals: Dict[str, float] = defaultdict(float)
+        for name, seconds in self.spans:
+            totals[name] += seconds
+        return ", ".join(
+            f'{name.replace(".", "-")};dur={seconds * 1000:.1f}' for name, seconds in totals.items()
+        )
+
+
+_request: contextvars.ContextVar[Optional[RequestTimings]] = contextvars.ContextVar("request_timings", default=None)
+
+
+class Registry:
+    """Holds counters and latency histograms and renders them for Prometheus."""
+
+    def __init__(self):
+        self._counters: Dict[Tuple[str, Labels], float] = defaultdict(float)
+        self._histograms: Dict[Tuple[str, Labels], List] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name: str, value: float, buckets: Tuple[float, ...] = BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(buckets), 0.0, 0, buckets]
+            index = bisect_left(histogram[3], value)
+            if index < len(histogram[3]):
+                histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: [list(value[0]), value[1], value[2], value[3]] for key, value in self._histograms.items()}
+
+        for name in sorted({name for name, _ in counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_format(labels)} {value:g}")
+
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (metric, labels), (buckets, total, count, bounds) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, bucket in zip(bounds, buckets):
+                    cumulative += bucket
+                    lines.append(f"{name}_bucket{_format(labels + (('le', f'{bound:g}'),))} {cumulative}")
+                lines.append(f"{name}_bucket{_format(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{_format(labels)} {total:g}")
+                lines.append(f"{name}_count{_format(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def _format(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+registry = Registry()
+
+
+@contextmanager
+def _span(name: str):
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = ""
+    finally:
+        seconds = time.perf_counter() - started
+        registry.observe("game_span_seconds", seconds, span=name)
+        events.record("span", name, seconds, outcome)
+        timings = _request.get()
+        if timings is not None:
+            timings.spans.append((name, seconds))
+
+
+def span(name: str):
+    """Times a stage of the game pipeline.
+
+    The duration goes to the ``game_span_seconds`` histogram, the event
+    log and the timings of the current request, if they are being recorded.
+    """
+    if not ENABLED:
+        return nullcontext()
+    return _span(name)
+
+
+def timed(name: str) -> Callable:
+    """Decorator version of `span`."""
+    def decorator(fn):
+        if not ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with _span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def count(name: str, **labels):
+    """Increments the ``game_<name>_total`` counter and the request's count of it.
+
+    The label values, in the order of their names, are the outcome of the
+    event that goes to the event log.
+    """
+    if not ENABLED:
+        return
+    registry.inc(f"game_{name}_total", **labels)
+    events.record("count", name, outcome="/".join(str(value) for _, value in sorted(labels.items())))
+    timings = _request.get()
+    if timings is not None:
+        timings.counts[name] += 1
+
+
+def observe(name: str, value: float, buckets: Tuple[float, ...] = BUCKETS, **labels):
+    """Adds a value to the ``game_<name>`` histogram."""
+    if ENABLED:
+        registry.observe(f"game_{name}", value, buckets, **labels)
+
+
+def request_counts() -> Dict[str, int]:
+    """Returns the counts of the request being recorded, empty if there is none."""
+    timings = _request.get()
+    return dict(timings.counts) if timings is not None else {}
+
+
+@contextmanager
+def record_request():
+    """Collects the spans and counts of everything run in this context."""
+    timings = RequestTimings()
+    token = _request.set(timings)
+    try:
+        yield timings
+    finally:
+        _request.reset(token)
+
+
+def propagate(fn: Callable) -> Callable:
+    """Wraps fn so that it runs with the caller's context in another thread."""
+    context = contextvars.copy_context()
+    # a context can only be entered by one thread at a time, so every call
+    # runs in its own copy
+    return lambda *args, **kwargs: context.copy().run(fn, *args, **kwargs)
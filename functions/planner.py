@@ -0,0 +1,148 @@
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from logging import getLogger
+from typing import Dict, List, Tuple
+
+from functions.geo import haversine
+from functions.maps import get_maps_client
+from functions.metrics import propagate, timed
+
+logger = getLogger(__name__)
+
+# the distance matrix API allows 100 elements, i.e. (1 + 9) x 9
+MAX_CANDIDATES = 9
+
+# seconds a player is assumed to spend at a waypoint solving the next riddle
+DWELL_SECONDS = float(os.getenv("PLANNER_DWELL_SECONDS", "300"))
+
+# used to estimate travel times when the distance matrix is not available
+WALKING_SPEED_MPS = 1.4
+
+
+def duration_matrix(api_key: str, origin: Dict, candidates: List[Dict]) -> List[List[float]]:
+    """Returns the travel times in seconds between the origin and the candidates.
+
+    Row 0 holds the times from the origin, row ``i`` the times from
+    candidate ``i - 1``. The times come from a single Distance Matrix call
+    and fall back to straight-line walking estimates.
+    """
+    places = [origin] + candidates
+    estimates = [
+        [
+            haversine(*a["coordinates"], *b["coordinates"]) / WALKING_SPEED_MPS
+            for b in candidates
+        ]
+        for a in places
+    ]
+
+    try:
+        rows = get_maps_client(api_key).distance_matrix(
+            [place["place_id"] for place in places],
+            [place["place_id"] for place in candidates],
+        )
+    except Exception:
+        logger.warning("Distance matrix failed, using estimates", exc_info=True)
+        return estimates
+
+    for i, row in enumerate(rows):
+        for j, element in enumerate(row.get("elements", [])):
+            if element.get("status") == "OK":
+                estimates[i][j] = element["duration"]["value"]
+    return estimates
+
+
+def solve(durations: List[List[float]], max_waypoints: int, budget: float,
+          dwell: float = DWELL_SECONDS) -> List[int]:
+    """Picks and orders the candidates to visit within the time budget.
+
+    This is a small orienteering problem that is solved exactly with a
+    Held-Karp style dynamic program over subsets of candidates: the tour
+    with the most waypoints wins, ties go to the shortest one.
+
+    Args:
+        durations (List[List[float]]): The matrix returned by `duration_matrix`.
+        max_waypoints (int): How many waypoints a game has at most.
+        budget (float): The time the player has, in seconds.
+        dwell (float): The time spent at every waypoint, in seconds.
+
+    Returns:
+        The indexes of the chosen candidates, in visiting order.
+    """
+    n = len(durations[0]) if durations else 0
+    # best[(mask, last)] = (time, previous) of the fastest tour that starts
+    # at the origin, visits the candidates in mask and ends at last
+    best: Dict[Tuple[int, int], Tuple[float, int]] = {}
+    for j in range(n):
+        cost = durations[0][j] + dwell
+        if cost <= budget:
+            best[(1 << j, j)] = (cost, -1)
+
+    layer = list(best)
+    for _ in range(1, max_waypoints):
+        next_layer = []
+        for mask, last in layer:
+            cost = best[(mask, last)][0]
+            for j in range(n):
+                if mask & (1 << j):
+                    continue
+                new_cost = cost + durations[last + 1][j] + dwell
+                key = (mask | (1 << j), j)
+                if new_cost > budget:
+                    continue
+                if key not in best:
+                    next_layer.append(key)
+                elif new_cost >= best[key][0]:
+                    continue
+                best[key] = (new_cost, last)
+        if not next_layer:
+            break
+        layer = next_layer
+
+    if not best:
+        return []
+    mask, last = min(best, key=lambda key: (-bin(key[0]).count("1"), best[key][0]))
+    order = []
+    while last != -1:
+        order.append(last)
+        mask, last = mask & ~(1 << last), best[(mask, last)][1]
+    return order[::-1]
+
+
+@timed("plan_waypoints")
+def plan_waypoints(api_key: str, origin: Dict, candidates: List[Dict], max_waypoints: int,
+                   budget: float) -> List[Dict]:
+    """Chooses the waypoints of a game and the order to visit them in.
+
+    Args:
+        api_key (str): The Google Maps API key.
+        origin (Dict): The player's starting place, with "place_id" and "lat_long".
+        candidates (List[Dict]): The places found for the player's interests.
+        max_waypoints (int): How many waypoints a game has at most.
+        budget (float): The time the player has, in seconds.
+    """
+    unique = list({place["place_id"]: place for place in candidates}.values())[:MAX_CANDIDATES]
+    with_coordinates = [
+        dict(place, coordinates=tuple(float(x) for x in place["lat_long"].split(",")))
+        for place in [origin] + unique
+    ]
+    durations = duration_matrix(api_key, with_coordinates[0], with_coordinates[1:])
+    order = solve(durations, max_waypoints, budget)
+    if len(order) < min(2, len(unique)):
+        # too little fits into the budget for a game, keep the places as they were found
+        return unique[:max_waypoints]
+    return [unique[index] for index in order]
+
+
+_route_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="routes")
+
+
+def cache_routes(api_key: str, place_ids: List[str]) -> List[Future]:
+    """Starts fetching the routes of all legs of a game so they end up in the Maps cache.
+
+    Returns immediately, the routes are fetched in the background.
+    """
+    maps = get_maps_client(api_key)
+    return [
+        _route_executor.submit(propagate(maps.directions), start, end)
+        for start, end in zip(place_ids, place_ids[1:])
+    ]
@@ -0,0 +1,85 @@
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from logging import getLogger
+from typing import Callable, Dict, Optional
+
+from functions.scheduler import PREFETCH, with_priority
+from functions.state import GAME_DURATION_SECONDS
+
+logger = getLogger(__name__)
+
+
+class Prefetcher:
+    """Runs work for a game in the background before the player needs it.
+
+    Results are stored per game under a name such as ``"riddle:2"`` and are
+    handed out once by `take`. Pending work of a game is dropped by `cancel`
+    when the game ends. Most games are abandoned rather than ended, so the
+    work of games older than ``max_age`` seconds is dropped too, by a sweep
+    that runs at most every ``sweep_interval`` seconds.
+    """
+
+    def __init__(self, max_workers: int = 4, max_age: float = GAME_DURATION_SECONDS,
+                 sweep_interval: float = 60.0):
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self._futures: Dict[str, Dict[str, Future]] = {}
+        # when the first work of every game was submitted
+        self._started: Dict[str, float] = {}
+        self._swept = time.monotonic()
+        self._lock = threading.Lock()
+
+    def submit(self, game_id: str, name: str, fn: Callable, *args, **kwargs):
+        self.sweep()
+        with self._lock:
+            if game_id not in self._futures:
+                self._started[game_id] = time.monotonic()
+            futures = self._futures.setdefault(game_id, {})
+            if name in futures:
+                return
+            # prefetched work yields to what players are waiting for
+            futures[name] = self._executor.submit(with_priority(PREFETCH, fn), *args, **kwargs)
+
+    def take(self, game_id: str, name: str, timeout: Optional[float] = None):
+        """Returns the prefetched result, or None if there is none or it failed.
+
+        Work that is still running is waited for, since that is never slower
+        than starting it again.
+        """
+        self.sweep()
+        with self._lock:
+            future = self._futures.get(game_id, {}).pop(name, None)
+        if future is None:
+            return None
+        try:
+            return future.result(timeout=timeout)
+        except Exception:
+            logger.warning("Prefetching %s for game %s failed", name, game_id, exc_info=True)
+            return None
+
+    def cancel(self, game_id: str):
+        with self._lock:
+            futures = self._futures.pop(game_id, {})
+            self._started.pop(game_id, None)
+        for future in futures.values():
+            future.cancel()
+
+    def sweep(self, force: bool = False):
+        """Drops the work of games that are over by now."""
+        now = time.monotonic()
+        if not force and now - self._swept < self.sweep_interval:
+            return
+        self._swept = now
+        with self._lock:
+            expired = [game_id for game_id, started in self._started.items() if now - started > self.max_age]
+        for game_id in expired:
+            self.cancel(game_id)
+
+    def __len__(self) -> int:
+        return len(self._futures)
+
+
+prefetcher = Prefetcher(max_workers=int(os.getenv("PREFETCH_WORKERS", "4")))
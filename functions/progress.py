@@ -0,0 +1,30 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Optional
+
+_listener: ContextVar[Optional[Callable[[str, Dict], None]]] = ContextVar("progress_listener", default=None)
+
+
+@contextmanager
+def listen(callback: Callable[[str, Dict], None]):
+    """Sends the events emitted in this context to ``callback(event, data)``."""
+    token = _listener.set(callback)
+    try:
+        yield
+    finally:
+        _listener.reset(token)
+
+
+def listening() -> bool:
+    return _listener.get() is not None
+
+
+def emit(event: str, data: Dict):
+    callback = _listener.get()
+    if callback is not None:
+        callback(event, data)
+
+
+def report(stage: str):
+    """Tells the listener, if any, which stage of the game pipeline is running."""
+    emit("progress", {"stage": stage})
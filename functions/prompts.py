@@ -0,0 +1,254 @@
+"""Bounded prompts for riddles and hints.
+
+The sights along a route and the details of a place can be arbitrarily
+long, so they are ranked and trimmed to fit a token budget before they are
+put into a prompt. That keeps the completion latency and cost bounded no
+matter how long the route is.
+"""
+import json
+import math
+import os
+import re
+from logging import getLogger
+from typing import Dict, List, Optional, Tuple
+
+from functions.metrics import SIZE_BUCKETS, observe
+
+logger = getLogger(__name__)
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# token budgets of the whole prompts
+RIDDLE_PROMPT_TOKENS = int(os.getenv("RIDDLE_PROMPT_TOKENS", "400"))
+HINT_PROMPT_TOKENS = int(os.getenv("HINT_PROMPT_TOKENS", "250"))
+GAME_PLAN_PROMPT_TOKENS = int(os.getenv("GAME_PLAN_PROMPT_TOKENS", "1500"))
+
+# the most sights a riddle prompt offers, however much budget is left
+MAX_SIGHTS = int(os.getenv("RIDDLE_MAX_SIGHTS", "12"))
+
+# the most sights per leg a game plan prompt offers
+MAX_PLAN_SIGHTS = int(os.getenv("GAME_PLAN_MAX_SIGHTS", "6"))
+
+# how good a riddle clue a place of a type makes, types not listed score 0
+TYPE_WEIGHTS = {
+    "museum": 5,
+    "art_gallery": 5,
+    "zoo": 5,
+    "aquarium": 5,
+    "amusement_park": 5,
+    "church": 4,
+    "hindu_temple": 4,
+    "mosque": 4,
+    "synagogue": 4,
+    "city_hall": 4,
+    "park": 4,
+    "movie_theater": 3,
+    "book_store": 3,
+    "campground": 3,
+    "shopping_mall": 3,
+    "bakery": 2,
+    "cafe": 2,
+    "bar": 2,
+    "restaurant": 2,
+    "night_club": 2,
+    "florist": 2,
+    "spa": 1,
+    "department_store": 1,
+    "jewelry_store": 1,
+    "clothing_store": 1,
+    "furniture_store": 1,
+    "point_of_interest": 0.5,
+}
+
+# the place details that help writing a hint, most useful first. anything
+# else (reviews, photos, opening hours, ...) is left out
+DETAIL_FIELDS = (
+    ("editorial_summary", lambda value: value.get("overview")),
+    ("types", lambda value: ", ".join(t.replace("_", " ") for t in value if t not in ("establishment", "point_of_interest"))),
+    ("vicinity", None),
+    ("formatted_address", None),
+    ("rating", None),
+    ("user_ratings_total", None),
+    ("price_level", None),
+)
+
+# the longest a single detail may be, in characters
+MAX_FACT_CHARS = 300
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    """Counts the tokens of a text, estimated at 4 characters per token without tiktoken."""
+    global _encoding
+    if tiktoken is None:
+        return math.ceil(len(text) / 4)
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding("cl100k_base")
+    return len(_encoding.encode(text))
+
+
+def salience(sight: Dict) -> float:
+    """Scores how good a clue a sight makes from its types and popularity."""
+    weight = max((TYPE_WEIGHTS.get(t, 0) for t in sight.get("types", [])), default=0)
+    return weight + math.log10(1 + (sight.get("user_ratings_total") or 0))
+
+
+def _normalize(name: str) -> str:
+    return re.sub(r"[^a-z0-9]+", " ", name.lower()).strip()
+
+
+def rank_sights(sights: List[Dict], exclude: Tuple[str, ...] = ()) -> List[str]:
+    """Returns the names of the sights, deduplicated and most salient first.
+
+    Sights that share a name (chains, several entrances of one park) are
+    kept once, and names in ``exclude`` are dropped.
+    """
+    excluded = {_normalize(name) for name in exclude if name}
+    best: Dict[str, Tuple[float, str]] = {}
+    for sight in sights:
+        name = sight.get("name")
+        if not name:
+            continue
+        key = _normalize(name)
+        if not key or key in excluded:
+            continue
+        score = salience(sight)
+        if key not in best or score > best[key][0]:
+            best[key] = (score, name)
+    return [name for _, name in sorted(best.values(), key=lambda item: -item[0])]
+
+
+def _fit(build, items: List[str], budget: int) -> Tuple[str, int, int]:
+    """Builds a prompt with as many of the leading items as fit the budget.
+
+    Returns the prompt, its number of tokens and the number of items used.
+    """
+    low, high = 0, len(items)
+    # the token count grows with the number of items, so binary search it
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(build(items[:middle])) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    prompt = build(items[:low])
+    return prompt, count_tokens(prompt), low
+
+
+def riddle_prompt(start_name: Optional[str], end_name: Optional[str], sights: List[Dict],
+                  budget: int = RIDDLE_PROMPT_TOKENS) -> Tuple[str, int]:
+    """Builds the prompt of a riddle leading from start to end.
+
+    Args:
+        start_name (str): The name of the start.
+        end_name (str): The name of the destination.
+        sights (List[Dict]): The sights along the route, as returned by `collect_sights`.
+        budget (int): The most tokens the prompt may have.
+
+    Returns:
+        The prompt and its number of tokens.
+    """
+    names = rank_sights(sights, exclude=(start_name, end_name))[:MAX_SIGHTS]
+
+    def build(points: List[str]) -> str:
+        return (
+            "You have a list of some notable points that lie in a path leading to some destination. "
+            "Build a riddle that uses some of these points (the ones you think are best suited to be used) as "
+            "clues to the destination. The riddle should be such that the answer to the riddle is the destination. "
+            "Don't mention the destination name in the riddle. "
+            f"The start location is {start_name} and more importantly, the destination is {end_name}. "
+            f"The notable points are as follows: {'; '.join(points)}. "
+            "Only output the riddle and nothing else."
+        )
+
+    prompt, tokens, used = _fit(build, names, budget)
+    observe("prompt_tokens", tokens, SIZE_BUCKETS, prompt="riddle")
+    logger.debug("Riddle prompt has %d tokens and %d of %d sights", tokens, used, len(sights))
+    return prompt, tokens
+
+
+def place_facts(details: Dict) -> List[str]:
+    """Picks the whitelisted fields of a place's details as short facts."""
+    facts = []
+    for field, render in DETAIL_FIELDS:
+        value = details.get(field)
+        if value in (None, "", [], {}):
+            continue
+        value = render(value) if render else value
+        if value in (None, ""):
+            continue
+        # a single long field must not crowd out all the others
+        facts.append(f"{field.replace('_', ' ')}: {str(value)[:MAX_FACT_CHARS]}")
+    return facts
+
+
+def hint_prompt(name: str, details: Dict, tier: int = 0, budget: int = HINT_PROMPT_TOKENS) -> Tuple[str, int]:
+    """Builds the prompt of a hint pointing to a place.
+
+    Args:
+        name (str): The name of the place.
+        details (Dict): The place's details, as returned by the Place Details API.
+        tier (int): How many hints the player already got for the place.
+        budget (int): The most tokens the prompt may have.
+
+    Returns:
+        The prompt and its number of tokens.
+    """
+    def build(facts: List[str]) -> str:
+        return (
+            "You are stuck at a location and need a hint to move forward. "
+            "The hint should be a sentence that gives a clue about the destination. "
+            f"The target location which is also the destination is {name}. "
+            f"The details of the location are as follows: {json.dumps(facts, ensure_ascii=False)}. "
+            + (f"The player already got {tier} hint(s) for it and is still stuck, "
+               "so make this hint clearly more direct than a first one. " if tier else "")
+            + "Output only the hint and nothing else."
+        )
+
+    prompt, tokens, _ = _fit(build, place_facts(details), budget)
+    observe("prompt_tokens", tokens, SIZE_BUCKETS, prompt="hint")
+    return prompt, tokens
+
+
+def game_plan_prompt(legs: List[Dict], hint_tiers: int, budget: int = GAME_PLAN_PROMPT_TOKENS) -> Tuple[str, int]:
+    """Builds the prompt that writes the riddles and hints of all legs of a game at once.
+
+    Every leg gets the same number of sights, as many as fit the budget
+    with the details of its destination.
+
+    Args:
+        legs (List[Dict]): The legs in order, with the "start" and "end"
+            names, the "sights" along the route and the "details" of the end.
+        hint_tiers (int): How many hints to write per leg.
+        budget (int): The most tokens the prompt may have.
+
+    Returns:
+        The prompt and its number of tokens.
+    """
+    ranked = [rank_sights(leg["sights"], exclude=(leg["start"], leg["end"])) for leg in legs]
+    facts = [json.dumps(place_facts(leg["details"]), ensure_ascii=False) for leg in legs]
+
+    def build(kept: List[int]) -> str:
+        lines = [
+            f"Leg {i + 1}: from {leg['start']} to {leg['end']}. "
+            f"Notable points: {'; '.join(names[:len(kept)]) or 'none'}. "
+            f"Details of {leg['end']}: {leg_facts}."
+            for i, (leg, names, leg_facts) in enumerate(zip(legs, ranked, facts))
+        ]
+        return (
+            "A scavenger hunt leads through the legs below, each from a start location to a destination. "
+            "For every leg, in order, build a riddle that uses some of its notable points as clues to the "
+            "destination, such that the answer to the riddle is the destination. "
+            "Don't mention the destination name in the riddle. "
+            f"Also write {hint_tiers} hints for every leg, each a sentence that gives a clue about the "
+            "destination, the first one subtle and every further one more direct.\n"
+            + "\n".join(lines)
+        )
+
+    prompt, tokens, _ = _fit(build, list(range(MAX_PLAN_SIGHTS)), budget)
+    observe("prompt_tokens", tokens, SIZE_BUCKETS, prompt="game_plan")
+    return prompt, tokens
@@ -0,0 +1,213 @@
+"""Rate limits outbound API calls per provider and API key.
+
+Every (provider, key) pair has a token bucket. Callers that find it empty
+queue up in priority order, so interactive requests go before prefetching
+and warm pool work. The depth of the queues tells the pipeline when to
+degrade instead of piling up more calls.
+"""
+import contextvars
+import hashlib
+import heapq
+import itertools
+import os
+import threading
+import time
+from logging import getLogger
+from typing import Callable, Dict, List, Optional, Tuple
+
+from functions.metrics import count, observe
+
+logger = getLogger(__name__)
+
+# priority classes, lower goes first
+INTERACTIVE = 0
+PREFETCH = 1
+BACKGROUND = 2
+
+PRIORITY_NAMES = {INTERACTIVE: "interactive", PREFETCH: "prefetch", BACKGROUND: "background"}
+
+# the longest a call waits for its turn before giving up, by priority
+MAX_WAIT_SECONDS = {
+    INTERACTIVE: float(os.getenv("RATE_LIMIT_MAX_WAIT", "10")),
+    PREFETCH: 30.0,
+    BACKGROUND: 60.0,
+}
+
+# requests per second allowed per API key, e.g. "maps=50,openai=5". the
+# buckets hold one second worth of requests
+RATE_LIMITS = {
+    provider: float(rate)
+    for provider, rate in (
+        item.split("=") for item in os.getenv("RATE_LIMITS", "maps=50,openai=5").split(",") if item
+    )
+}
+
+# seconds a key is paused after the provider said it is over its quota
+THROTTLE_SECONDS = float(os.getenv("RATE_LIMIT_THROTTLE_SECONDS", "1"))
+
+# from this many queued calls on, a provider counts as congested
+QUEUE_HIGH = int(os.getenv("RATE_LIMIT_QUEUE_HIGH", "16"))
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar("priority", default=INTERACTIVE)
+_sequence = itertools.count()
+
+
+class RateLimitedError(Exception):
+    """A call waited too long for its turn."""
+
+
+def current_priority() -> int:
+    return _priority.get()
+
+
+def with_priority(priority: int, fn: Callable) -> Callable:
+    """Wraps fn so that the calls it makes are scheduled with ``priority``."""
+    def wrapper(*args, **kwargs):
+        token = _priority.set(priority)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _priority.reset(token)
+    return wrapper
+
+
+class TokenBucket:
+    """A token bucket whose waiters are served by priority, then in order of arrival."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._waiters: List[Tuple[int, int]] = []
+        self._condition = threading.Condition()
+
+    @property
+    def depth(self) -> int:
+        return len(self._waiters)
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, priority: int, timeout: float) -> bool:
+        """Takes a token, waiting at most ``timeout`` seconds for it."""
+        entry = (priority, next(_sequence))
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            heapq.heappush(self._waiters, entry)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    first = self._waiters[0] == entry
+                    if first and self.tokens >= 1 and now >= self.paused_until:
+                        self.tokens -= 1
+                        return True
+                    if now >= deadline:
+                        return False
+                    # the first waiter sleeps until the next token, the
+                    # others until the first one is served
+                    wait = deadline - now
+                    if first:
+                        wait = min(wait, max((1 - self.tokens) / self.rate, self.paused_until - now))
+                    self._condition.wait(wait)
+            finally:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._condition.notify_all()
+
+    def try_acquire(self) -> bool:
+        """Takes a token only if one is free and nobody is waiting for it."""
+        with self._condition:
+            now = time.monotonic()
+            self._refill(now)
+            if self._waiters or self.tokens < 1 or now < self.paused_until:
+                return False
+            self.tokens -= 1
+            return True
+
+    def throttle(self, seconds: float):
+        """Hands out no tokens for a while."""
+        with self._condition:
+            self.tokens = 0
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class Scheduler:
+    """Hands out the calls to every provider and API key at the allowed rate.
+
+    Providers without a configured rate are not limited.
+    """
+
+    def __init__(self, limits: Dict[str, float]):
+        self.limits = limits
+        self._buckets: Dict[Tuple[str, str], TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, provider: str, key: Optional[str]) -> Optional[TokenBucket]:
+        rate = self.limits.get(provider)
+        if not rate:
+            return None
+        # API keys are not kept around in the clear
+        name = (provider, hashlib.sha1((key or "").encode()).hexdigest()[:8])
+        with self._lock:
+            bucket = self._buckets.get(name)
+            if bucket is None:
+                bucket = self._buckets[name] = TokenBucket(rate, max(rate, 1.0))
+            return bucket
+
+    def acquire(self, provider: str, key: Optional[str]):
+        """Waits for the turn of a call with the current priority.
+
+        Raises:
+            RateLimitedError: The call waited longer than its priority allows.
+        """
+        bucket = self._bucket(provider, key)
+        if bucket is None:
+            return
+        priority = current_priority()
+        started = time.perf_counter()
+        acquired = bucket.acquire(priority, MAX_WAIT_SECONDS[priority])
+        waited = time.perf_counter() - started
+        if waited > 0.001:
+            observe("rate_limit_wait_seconds", waited, provider=provider, priority=PRIORITY_NAMES[priority])
+        if not acquired:
+            count("rate_limited", provider=provider, priority=PRIORITY_NAMES[priority])
+            raise RateLimitedError(provider)
+
+    def try_acquire(self, provider: str, key: Optional[str]) -> bool:
+        bucket = self._bucket(provider, key)
+        return bucket is None or bucket.try_acquire()
+
+    def throttle(self, provider: str, key: Optional[str], seconds: float = THROTTLE_SECONDS):
+        """Backs off after the provider answered that the key is over its quota."""
+        bucket = self._bucket(provider, key)
+        if bucket is not None:
+            count("rate_limit_throttles", provider=provider)
+            bucket.throttle(seconds)
+
+    def depth(self, provider: str) -> int:
+        """Returns how many calls to a provider are waiting for their turn."""
+        with self._lock:
+            buckets = [bucket for (name, _), bucket in self._buckets.items() if name == provider]
+        return sum(bucket.depth for bucket in buckets)
+
+    def congested(self, provider: str) -> bool:
+        return self.depth(provider) >= QUEUE_HIGH
+
+    def stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            buckets = dict(self._buckets)
+        return {
+            f"{provider}/{key}": {
+                "rate": bucket.rate,
+                "tokens": round(bucket.tokens, 2),
+                "waiting": bucket.depth,
+            }
+            for (provider, key), bucket in sorted(buckets.items())
+        }
+
+
+scheduler = Scheduler(RATE_LIMITS)
@@ -0,0 +1,167 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from typing import Dict, List, Tuple
+
+from functions.geo import haversine
+from functions.maps import get_maps_client
+from functions.metrics import count, propagate, timed
+from functions.scheduler import scheduler
+
+logger = getLogger(__name__)
+
+# distance between two sampled points along the route, in metres
+SAMPLE_SPACING_M = float(os.getenv("SIGHTS_SAMPLE_SPACING_M", "150"))
+
+# place types that make sense to be used to generate a riddle. for example,
+# "route" is not included because a street is not good riddle fodder.
+INCLUDED_TYPES = {
+    "amusement_park",
+    "aquarium",
+    "art_gallery",
+    "bakery",
+    "bar",
+    "book_store",
+    "cafe",
+    "campground",
+    "church",
+    "hindu_temple",
+    "mosque",
+    "city_hall",
+    "clothing_store",
+    "convenience_store",
+    "department_store",
+    "electronics_store",
+    "florist",
+    "furniture_store",
+    "grocery_or_supermarket",
+    "hardware_store",
+    "home_goods_store",
+    "jewelry_store",
+    "liquor_store",
+    "meal_delivery",
+    "meal_takeaway",
+    "movie_theater",
+    "museum",
+    "night_club",
+    "park",
+    "restaurant",
+    "shopping_mall",
+    "spa",
+    "store",
+    "zoo",
+    "point_of_interest",
+}
+
+_executor = ThreadPoolExecutor(max_workers=int(os.getenv("SIGHTS_CONCURRENCY", "8")),
+                               thread_name_prefix="sights")
+
+
+def decode_polyline(encoded: str) -> List[Tuple[float, float]]:
+    """Decodes a Google encoded polyline into (lat, lng) pairs."""
+    points = []
+    index = lat = lng = 0
+    while index < len(encoded):
+        deltas = []
+        for _ in range(2):
+            shift = result = 0
+            while True:
+                byte = ord(encoded[index]) - 63
+                index += 1
+                result |= (byte & 0x1F) << shift
+                shift += 5
+                if byte < 0x20:
+                    break
+            deltas.append(~(result >> 1) if result & 1 else result >> 1)
+        lat += deltas[0]
+        lng += deltas[1]
+        points.append((lat / 1e5, lng / 1e5))
+    return points
+
+
+def sample_points(points: List[Tuple[float, float]], spacing: float = SAMPLE_SPACING_M) -> List[Tuple[float, float]]:
+    """Picks points every ``spacing`` metres along a path.
+
+    Points closer than ``spacing / 2`` to an already picked point are
+    dropped, so routes that double back don't get queried twice.
+    """
+    if not points:
+        return []
+
+    sampled = [points[0]]
+    travelled = 0.0
+    for previous, point in zip(points, points[1:]):
+        travelled += haversine(previous[0], previous[1], point[0], point[1])
+        if travelled < spacing:
+            continue
+        travelled = 0.0
+        if all(haversine(point[0], point[1], lat, lng) >= spacing / 2 for lat, lng in sampled):
+            sampled.append(point)
+
+    last = points[-1]
+    if all(haversine(last[0], last[1], lat, lng) >= spacing / 2 for lat, lng in sampled):
+        sampled.append(last)
+    return sampled
+
+
+def route_points(route: Dict) -> List[Tuple[float, float]]:
+    """Returns the points of a Directions route, preferring its overview polyline."""
+    polyline = route.get("overview_polyline", {}).get("points")
+    if polyline:
+        return decode_polyline(polyline)
+    return [
+        (step["end_location"]["lat"], step["end_location"]["lng"])
+        for leg in route.get("legs", [])
+        for step in leg.get("steps", [])
+    ]
+
+
+@timed("sights")
+def collect_sights(api_key: str, route: Dict, spacing: float = SAMPLE_SPACING_M,
+                   included_types=INCLUDED_TYPES, timeout: float = 5.0) -> List[Dict]:
+    """Finds the notable sights along a route.
+
+    The route is sampled every ``spacing`` metres, every sample is looked up
+    concurrently with a radius that covers the gap to its neighbours and the
+    results are merged by place id. The samples are spread out further
+    while the Maps quota is congested.
+
+    Args:
+        api_key (str): The Google Maps API key.
+        route (Dict): A route as returned by the Directions API.
+        spacing (float): The distance between two sampled points in metres.
+        included_types (Set[str]): Only places with one of these types are kept.
+        timeout (float): The timeout of a single search in seconds.
+    """
+    maps = get_maps_client(api_key)
+    if scheduler.congested("maps"):
+        # half the searches, with each one covering twice the distance
+        count("degraded", stage="sights")
+        spacing *= 2
+    radius = max(int(spacing / 2), 10)
+
+    def search(point):
+        try:
+            return maps.nearby_search(f"{point[0]},{point[1]}", radius, timeout=timeout)
+        except Exception:
+            logger.warning("Sights search around %s failed", point, exc_info=True)
+            return []
+
+    points = sample_points(route_points(route), spacing)
+    sights = {}
+    for results in _executor.map(propagate(search), points):
+        for place in results:
+            if place.get('place_id') in sights:
+                continue
+            if included_types and not included_types.intersection(place.get('types', [])):
+                continue
+            sights[place.get('place_id')] = {
+                'name': place.get('name'),
+                'location': place.get('geometry', {}).get('location'),
+                'types': place.get('types', []),
+                'rating': place.get('rating'),
+                'user_ratings_total': place.get('user_ratings_total', 0),
+            }
+
+    logger.info("Found %d sights with %d searches", len(sights), len(points))
+    return list(sights.values())
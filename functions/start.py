@@ -1,51 +1,125 @@
-from typing import Dict
-from openai import OpenAI
-import requests
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple, Union
 import os
 import time
 from logging import getLogger
 
+from functions.events import logged
+from functions.game_plan import PLAN_GAME, plan_game
 from functions.generate_riddle_function import generate_riddle
+from functions.geo import haversine, parse_lat_lng
+from functions.llm import complete, interests_cache, recall_latest, remember_latest
+from functions.maps import get_maps_client
+from functions.metrics import count, propagate, timed
+from functions.prefetch import prefetcher
+from functions.progress import report
+from functions.prompts import hint_prompt
+from functions.scheduler import scheduler
+from functions.planner import MAX_CANDIDATES, cache_routes, plan_waypoints
+from functions.state import GAME_DURATION_SECONDS, GameState, get_state_backend
+from functions.targets import TARGET_REFRESH_SECONDS, VERIFY_RADIUS_M, targets
+from functions.warm_pool import WARM_POOL, WarmPool, parse_seeds
 # from functions.settings import get_settings
 
 logger = getLogger(__name__)
 
-current_target = 0
+# the game id used by callers that don't pass one
+DEFAULT_GAME_ID = "default"
 
-def get_places(api_key, location, radius, keywords):
-    base_url = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
-    places = []
+NO_GAME_MESSAGE = "There is no game in progress. Tell me your interests to start a new one."
+NO_PLACES_MESSAGE = "I couldn't find any places matching your interests nearby. Try some other interests."
+NO_LOCATION_MESSAGE = "I couldn't work out where you are. Please send your location again."
+TIME_UP_MESSAGE = "The time has run out. You have taken too long to complete the game. You have covered {} points."
+FINISHED_MESSAGE = "Congratulations! You have reached the destination. You have successfully completed the game."
+WRONG_ANSWER_MESSAGE = "Sorry, the answer is incorrect. Please try again. You can also ask for a hint if you need one."
 
-    for keyword in keywords:
-        params = {
-            "location": location,
-            "radius": radius,
-            "keyword": keyword,
-            "key": api_key,
-        }
+# the outcomes of checking an answer
+NO_GAME = "no_game"
+EXPIRED = "expired"
+WRONG = "wrong"
+NEXT_RIDDLE = "riddle"
+FINISHED = "complete"
 
-        response = requests.get(base_url, params=params)
+# how far from the destination a photo of it is accepted instead, in metres
+IMAGE_VERIFY_RADIUS_M = float(os.getenv("IMAGE_VERIFY_RADIUS_M", "300"))
 
-        results = response.json().get("results", [])
+# whether the hint for a waypoint is prepared together with its riddle
+PREFETCH_HINTS = os.getenv("PREFETCH_HINTS", "0") == "1"
 
-        for place in results[:2]:  # Get top 2 places for each keyword
-            places.append({  
-                'name': place.get('name'),
-                'place_id': place.get('place_id'),
-                'lat_long': str(place.get("geometry").get('location').get('lat')) + ',' + str(place.get("geometry").get('location').get('lng'))
-            })
+# places searches run here. asyncio.run() joins the default executor before
+# it returns, which would make every call wait for its cancelled searches
+_search_executor = ThreadPoolExecutor(max_workers=int(os.getenv("SEARCH_CONCURRENCY", "16")),
+                                      thread_name_prefix="search")
 
-    # return five random places
-    places = places[:5]
+async def get_places_async(api_key, location, radius, keywords, max_places=5,
+                           concurrency=8, timeout=5.0):
+    """Searches the places for all keywords at once.
 
-    # define a global list_places object of type Dict[str, str]
-    global list_places
+    The top two places of every keyword are kept, in keyword order, and the
+    remaining searches are cancelled as soon as ``max_places`` are known.
 
-    # generate an ordered list from places
-    list_places = {index: place for index, place in enumerate(places)}
+    Args:
+        api_key (str): The Google Maps API key.
+        location (str): The "lat,lng" to search around.
+        radius (int): The search radius in metres.
+        keywords (List[str]): The keywords to search for.
+        max_places (int): How many places to return.
+        concurrency (int): How many searches may be in flight at once.
+        timeout (float): The timeout of a single search in seconds.
+    """
+    maps = get_maps_client(api_key)
+    semaphore = asyncio.Semaphore(concurrency)
+    loop = asyncio.get_running_loop()
+
+    async def search(keyword):
+        async with semaphore:
+            try:
+                return await loop.run_in_executor(
+                    _search_executor, propagate(functools.partial(maps.nearby_search, location, radius, keyword, timeout=timeout))
+                )
+            except Exception:
+                logger.warning("Places search for %s failed", keyword, exc_info=True)
+                return []
+
+    tasks = [asyncio.ensure_future(search(keyword)) for keyword in keywords]
+    results = [None] * len(tasks)
+    places = []
+    done = 0
+    try:
+        for index, task in enumerate(tasks):
+            results[index] = await task
+            # results are consumed in keyword order so the outcome doesn't
+            # depend on which search happens to come back first
+            for place in results[index][:2]:  # Get top 2 places for each keyword
+                places.append({
+                    'name': place.get('name'),
+                    'place_id': place.get('place_id'),
+                    'lat_long': str(place.get("geometry").get('location').get('lat')) + ',' + str(place.get("geometry").get('location').get('lng'))
+                })
+            done = index + 1
+            if len(places) >= max_places:
+                break
+    finally:
+        for task in tasks[done:]:
+            task.cancel()
+
+    return places[:max_places]
+
+
+@timed("get_places")
+def get_places(api_key, location, radius, keywords, max_places=5):
+    """Returns the first ``max_places`` places found for the keywords.
+
+    This is a blocking wrapper around `get_places_async`.
+    """
+    places = asyncio.run(get_places_async(api_key, location, radius, keywords, max_places))
 
-    print("All places", list_places)
+    logger.info("All places: %s", places)
+    return places
 
+@timed("get_keywords")
 def get_keywords(interests: str):
     """Generates a list of keywords based on the user's interests.
 
@@ -63,121 +137,330 @@ def get_keywords(interests: str):
         "Output only the list and nothing else ".format(interests)
     )
 
-    openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-
-    response = openai_client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant."},
-            {"role": "user", "content": prompt},
-        ]
-    )
+    if interests_cache is not None:
+        keywords = interests_cache.get(interests)
+        if keywords is not None:
+            return keywords
 
-    keywords = response.choices[0].message.content.split(", ")
+    keywords = complete(prompt).split(", ")
+    if interests_cache is not None:
+        interests_cache.put(interests, keywords)
     return keywords
 
 
-def start_game(current_location: str, user_interests: str):
+@logged("start_game", "current_location", "user_interests")
+def start_game(current_location: str, user_interests: str, game_id: str = DEFAULT_GAME_ID):
     """Generates a list of all possible waypoints and the first ever riddle.
 
+    A game from the warm pool is used when one is ready for the player's
+    area and interests.
+
     Args:
         current_location (str): The user's current location.
+        user_interests (str): The user's interests.
+        game_id (str): The id under which the game state is stored.
+    """
+    game = None
+    if warm_pool is not None:
+        warm_pool.record(current_location, user_interests)
+        game = warm_pool.claim(current_location, user_interests)
+    if game is None:
+        game = build_game(current_location, user_interests)
+        if isinstance(game, str):
+            return game
+
+    # a new game always starts at the first waypoint
+    prefetcher.cancel(game_id)
+    state = GameState(game_id, game["waypoints"], plan=game["plan"])
+    get_state_backend().put(state)
+    targets.update(game_id, *state.target_coordinates(), started=state.start_time)
+    if game["plan"] is None:
+        prefetch_next(game_id, game["waypoints"], 0)
+    return game["riddle"]
+
+
+def build_game(current_location: str, user_interests: str) -> Union[str, Dict]:
+    """Builds a game without starting it.
+
+    Args:
+        current_location (str): The location the game starts at.
+        user_interests (str): The player's interests.
+
+    Returns:
+        The "waypoints", the "plan" (None if the riddles are written one by
+        one) and the first "riddle" of the game, or a message for the
+        player if no game can be built.
     """
-    global start_time
-    start_time = time.time()
     api_key = os.getenv("MAPS_API_KEY")
+    report("understanding interests")
     keywords = get_keywords(interests=user_interests)
-    get_places(api_key, current_location, 1000, keywords)
+    report("finding places")
+    # a few more places than needed so that the planner has a choice
+    candidates = get_places(api_key, current_location, 1000, keywords, max_places=MAX_CANDIDATES)
+
+    logger.info("Current Location: %s", current_location)
+
+    if not candidates:
+        return NO_PLACES_MESSAGE
+
+    # get the place ID for the current location, looking a bit further if
+    # nothing is right next to the player
+    maps = get_maps_client(api_key)
+    nearby = maps.nearby_search(current_location, 50) or maps.nearby_search(current_location, 500)
+    if not nearby:
+        return NO_LOCATION_MESSAGE
+    origin = {"place_id": nearby[0]["place_id"], "lat_long": current_location}
+    current_location = origin["place_id"]
 
-    logger.info("Current Location: ", current_location)
+    report("planning route")
+    list_places = plan_waypoints(api_key, origin, candidates, max_waypoints=5, budget=GAME_DURATION_SECONDS)
 
-    # get the place ID for the current location
-    place_url = "https://maps.googleapis.com/maps/api/place/nearbysearch/json"
-    params = {
-        "location": current_location,
-        "radius": 50,
-        "key": api_key
-    }
-    response = requests.get(place_url, params=params)
-    current_location = response.json().get("results", [])[0]["place_id"]
+    # the first leg is needed right away, the others are fetched in the background
+    cache_routes(api_key, [place["place_id"] for place in list_places])
 
-    # set the current target to 0
-    global current_target
-    current_target = 0
+    plan = None
+    if PLAN_GAME:
+        report("writing riddles")
+        plan = plan_game(api_key, current_location, list_places)
+    if plan is not None:
+        first_riddle = plan["riddles"][0]
+    else:
+        first_riddle = generate_riddle(api_key, current_location, list_places[0]["place_id"])
+    return {"waypoints": list_places, "plan": plan, "riddle": first_riddle}
 
-    first_riddle = generate_riddle(api_key, current_location, list_places[0]["place_id"])
-    return first_riddle
 
-def verify(current_location: str, image: str = None):
+def has_active_game(game_id: str) -> bool:
+    """Tells whether a game is in progress and its time hasn't run out."""
+    state = get_state_backend().get(game_id)
+    return state is not None and time.time() - state.start_time <= GAME_DURATION_SECONDS
+
+
+def prefetch_next(game_id: str, list_places, current_target: int):
+    """Prepares the riddle that follows the one for ``current_target``.
+
+    Args:
+        game_id (str): The id of the game being played.
+        list_places (List[Dict]): The waypoints of the game.
+        current_target (int): The waypoint whose riddle was just served.
+    """
+    if PREFETCH_HINTS:
+        prefetcher.submit(game_id, f"hint:{current_target}", generate_hint, list_places[current_target])
+
+    next_target = current_target + 1
+    # the game is over once the player reaches the second to last waypoint
+    if next_target >= len(list_places) - 1:
+        return
+    prefetcher.submit(
+        game_id,
+        f"riddle:{next_target}",
+        generate_riddle,
+        os.getenv("MAPS_API_KEY"),
+        list_places[current_target]["place_id"],
+        list_places[next_target]["place_id"],
+    )
+
+def verify(current_location: str, image: Optional[bytes] = None, game_id: str = DEFAULT_GAME_ID):
     """Verifies the answer to the riddle.
 
+    A player who is not quite close enough can still prove having found the
+    destination with a photo of it.
+
     Args:
-        image (str): The image of the destination that is the answer to the riddle.
+        image (bytes): A photo of the destination that is the answer to the riddle.
         current_location (str): The user's current location in coordinates.
+        game_id (str): The id of the game being played.
     """
+    return check_answer(current_location, image=image, game_id=game_id)[1]
+
+
+@logged("verify", "current_location", outcome=lambda result: result[0])
+def check_answer(current_location: str, image: Optional[bytes] = None,
+                 game_id: str = DEFAULT_GAME_ID) -> Tuple[str, str]:
+    """Verifies the answer to the riddle like `verify`.
+
+    Returns:
+        The outcome (NO_GAME, EXPIRED, WRONG, NEXT_RIDDLE or FINISHED) and
+        the message for the player, which is the next riddle on NEXT_RIDDLE.
+    """
+    backend = get_state_backend()
+    state = backend.get(game_id)
+    if state is None:
+        return NO_GAME, NO_GAME_MESSAGE
+    list_places = state.waypoints
+    current_target = state.target
+
     # check if the time has run out
-    if time.time() - start_time > 3600:
-        return "The time has run out. You have taken too long to complete the game. You have covered {} points.".format(current_target)
-
-    # check if the current location coordinates match the verify input coordinates upto 2 metres
-    range_of_error = 2
-    # get the coordinates of the current location
-    current_location = current_location.split(",")
-    # get the coordinates of the destination
-    # print("Current target", current_target)
-    destination = list_places[current_target]["lat_long"].split(",")
-
-    # check if the coordinates match
-    if abs(float(current_location[0]) - float(destination[0])) <= range_of_error and abs(float(current_location[1]) - float(destination[1])) <= range_of_error:
-        # increment the current target
-        current_target += 1
-        # check if the current target is the last target
-        if current_target == len(list_places) - 1:
-            return "Congratulations! You have reached the destination. You have successfully completed the game."
+    if time.time() - state.start_time > GAME_DURATION_SECONDS:
+        end_game(game_id)
+        return EXPIRED, TIME_UP_MESSAGE.format(current_target)
+
+    # check if the current location is within VERIFY_RADIUS_M metres of the destination
+    lat, lng = parse_lat_lng(current_location)
+    destination = state.target_coordinates()
+
+    distance = haversine(lat, lng, destination[0], destination[1])
+    reached = distance <= VERIFY_RADIUS_M
+    if not reached and image is not None and distance <= IMAGE_VERIFY_RADIUS_M:
+        # Pillow is only needed once somebody sends a photo
+        from functions.images import check_image
+
+        report("checking photo")
+        reached = check_image(image, list_places[current_target])
+
+    if reached:
+        def advance(state: GameState) -> Tuple[GameState, int]:
+            # another request may have answered this riddle meanwhile
+            if state.target == current_target:
+                state.target += 1
+                state.hint_tier = 0
+            return state, state.target
+
+        # the target is changed in a single step, so that a hint asked for at
+        # the same time, maybe on another worker, doesn't write back the old one
+        advanced = backend.update(game_id, advance)
+        if advanced is None:
+            return NO_GAME, NO_GAME_MESSAGE
+        state, current_target = advanced
+        # check if the current target is the last target, or the game had only one
+        if current_target >= len(list_places) - 1:
+            end_game(game_id)
+            return FINISHED, FINISHED_MESSAGE
         else:
-            # get the next riddle
-            next_riddle = generate_riddle(os.getenv("MAPS_API_KEY"), list_places[current_target - 1]["place_id"], list_places[current_target]["place_id"])
-            return next_riddle
+            targets.update(game_id, *state.coordinates[current_target], started=state.start_time)
+            if state.plan is not None:
+                return NEXT_RIDDLE, state.plan["riddles"][current_target]
+            # get the next riddle, which is usually prepared already
+            next_riddle = prefetcher.take(game_id, f"riddle:{current_target}")
+            if next_riddle is None:
+                next_riddle = generate_riddle(os.getenv("MAPS_API_KEY"), list_places[current_target - 1]["place_id"], list_places[current_target]["place_id"])
+            prefetch_next(game_id, list_places, current_target)
+            return NEXT_RIDDLE, next_riddle
     
     
-    return "Sorry, the answer is incorrect. Please try again. You can also ask for a hint if you need one."
+    return WRONG, WRONG_ANSWER_MESSAGE
 
-def get_hint():
-    """Returns a hint for the current riddle."""
-    # TODO: only allow a fixed number of hints
-    # find the current target location
-    current_target_location = list_places[current_target]["name"]
+def verify_batch(pings: List[Tuple[str, str]]) -> List[Optional[str]]:
+    """Verifies the locations of many players at once.
 
-    # get the place details for the current target location
-    places_url = "https://maps.googleapis.com/maps/api/place/details/json"
+    The pings are checked against the targets of all active games in one
+    vectorized pass, and only the players that reached their target go
+    through `verify`.
 
-    params = {
-        'place_id': list_places[current_target]["place_id"],
-        'key': os.getenv("MAPS_API_KEY")
-    }
+    Args:
+        pings (List[Tuple[str, str]]): (game id, "lat,lng") pairs.
 
-    response = requests.get(places_url, params=params)
-    place_details = response.json().get('result', {})
+    Returns:
+        The result of `verify` for every ping that reached its target and
+        None for the others.
+    """
+    found = reached_targets(pings)
+    return [
+        verify(location, game_id=game_id) if hit else None
+        for (game_id, location), hit in zip(pings, found)
+    ]
 
-    # call the OpenAI API to generate a hint
-    openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-    prompt = (
-        "You are stuck at a location and need a hint to move forward. "
-        "The hint should be a sentence that gives a clue about the destination. "
-        "The target location which is also the destination is {}. "
-        "The details of the location are as follows: {}."
-        "Output only the hint and nothing else.".format(current_target_location, place_details)
-    )
+def reached_targets(pings: List[Tuple[str, str]]) -> List[bool]:
+    """Tells for every (game id, "lat,lng") ping whether it is within reach of its game's target.
 
-    response = openai_client.chat.completions.create(
-        # TODO: Change the model to GPT-4o
-        model="gpt-3.5-turbo",
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant."},
-            {"role": "user", "content": prompt},
-        ]
-    )
+    This only looks at the target index, the answers still have to be
+    checked with `verify`.
+    """
+    # games started or moved on by another worker are missing or out of
+    # date in this process, so with a shared backend the index is reloaded
+    # every few seconds
+    backend = get_state_backend()
+    game_ids = {game_id for game_id, _ in pings}
+    if backend.shared:
+        reload = targets.stale(game_ids, TARGET_REFRESH_SECONDS)
+    else:
+        reload = [game_id for game_id in game_ids if game_id not in targets]
+    for game_id in reload:
+        state = backend.get(game_id)
+        if state is None:
+            targets.remove(game_id)
+        else:
+            targets.update(game_id, *state.target_coordinates(), started=state.start_time)
 
-    hint = response.choices[0].message.content
+    parsed = [(game_id, *parse_lat_lng(location)) for game_id, location in pings]
+    return [bool(hit) for hit in targets.check(parsed)]
+
+
+def end_game(game_id: str):
+    """Forgets a game and drops the work prepared for it."""
+    get_state_backend().delete(game_id)
+    prefetcher.cancel(game_id)
+    targets.remove(game_id)
+
+
+@logged("get_hint")
+def get_hint(game_id: str = DEFAULT_GAME_ID):
+    """Returns a hint for the current riddle.
+
+    Args:
+        game_id (str): The id of the game being played.
+    """
+    def ask(state: GameState) -> Tuple[GameState, int, int]:
+        # TODO: only allow a fixed number of hints
+        state.hints += 1
+        state.hint_tier += 1
+        return state, state.target, state.hint_tier - 1
+
+    # the counters are changed in a single step, so that an answer checked
+    # at the same time, maybe on another worker, isn't undone
+    asked = get_state_backend().update(game_id, ask)
+    if asked is None:
+        return NO_GAME_MESSAGE
+    state, current_target, tier = asked
+    list_places = state.waypoints
+
+    # the planned hints get more direct with every hint asked for, and
+    # further hints are written on demand
+    if state.plan is not None and tier < len(state.plan["hints"][current_target]):
+        return state.plan["hints"][current_target][tier]
+
+    report("writing hint")
+    # only the first hint is prefetched, later ones are written to be more direct
+    hint = prefetcher.take(game_id, f"hint:{current_target}") if tier == 0 else None
+    if hint is None:
+        hint = generate_hint(list_places[current_target], tier)
     return hint
+
+
+@timed("generate_hint")
+def generate_hint(place: Dict, tier: int = 0):
+    """Generates a hint that points the player to a waypoint.
+
+    Args:
+        place (Dict): The waypoint the player is looking for.
+        tier (int): How many hints the player already got for the waypoint,
+            which makes the hint more direct and keeps it from being the
+            cached answer to an earlier ask.
+    """
+    if scheduler.congested("openai"):
+        hint = recall_latest("hint", place["place_id"])
+        if hint is not None:
+            count("degraded", stage="hint")
+            return hint
+
+    # find the current target location
+    current_target_location = place["name"]
+
+    # get the place details for the current target location
+    place_details = get_maps_client().place_details(place["place_id"])
+
+    # call the OpenAI API with the relevant details only
+    prompt, _ = hint_prompt(current_target_location, place_details, tier)
+
+    # TODO: Change the model to GPT-4o
+    hint = complete(prompt, stream=True)
+    remember_latest("hint", place["place_id"], hint)
+    return hint
+
+
+# games built ahead of time for busy areas, started by the server
+warm_pool = (
+    WarmPool(build_game, seeds=parse_seeds(os.getenv("WARM_POOL_SEEDS", "")),
+             workers=int(os.getenv("WARM_POOL_WORKERS", "2")))
+    if WARM_POOL else None
+)
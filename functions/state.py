@@ -0,0 +1,198 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple, TypeVar
+
+from functions.geo import parse_lat_lng
+
+# how long a player has to finish a game, in seconds
+GAME_DURATION_SECONDS = 3600
+
+# games older than this are dropped by the backends
+GAME_TTL_SECONDS = int(os.getenv("GAME_TTL_SECONDS", str(2 * 3600)))
+
+T = TypeVar("T")
+
+
+class GameState:
+    """The state of a single game.
+
+    Attributes:
+        game_id (str): The id of the game, usually the player's session token.
+        waypoints (List[Dict]): The places the player has to find, in order.
+        target (int): The index of the waypoint the player is looking for.
+        start_time (float): When the game was started (unix time).
+        hints (int): How many hints the player has asked for.
+        coordinates (List[List[float]]): The [lat, lng] of every waypoint, parsed once.
+        plan (Dict): The riddles and tiered hints of all waypoints written up
+            front, None if they are written one by one.
+        hint_tier (int): How many hints the player has asked for at the current waypoint.
+    """
+
+    __slots__ = ("game_id", "waypoints", "target", "start_time", "hints", "coordinates", "plan", "hint_tier")
+
+    def __init__(self, game_id: str, waypoints: List[Dict], target: int = 0,
+                 start_time: Optional[float] = None, hints: int = 0,
+                 coordinates: Optional[List[List[float]]] = None,
+                 plan: Optional[Dict] = None, hint_tier: int = 0):
+        self.game_id = game_id
+        self.waypoints = waypoints
+        self.target = target
+        self.start_time = time.time() if start_time is None else start_time
+        self.hints = hints
+        if coordinates is None:
+            coordinates = [list(parse_lat_lng(place["lat_long"])) for place in waypoints]
+        self.coordinates = coordinates
+        self.plan = plan
+        self.hint_tier = hint_tier
+
+    def target_coordinates(self) -> Tuple[float, float]:
+        lat, lng = self.coordinates[self.target]
+        return lat, lng
+
+    def to_dict(self) -> Dict:
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "GameState":
+        return cls(**data)
+
+
+class MemoryStateBackend:
+    """Keeps games in process memory with LRU and TTL eviction."""
+
+    # whether other processes change the games too
+    shared = False
+
+    def __init__(self, max_games: int = 10000, ttl: int = GAME_TTL_SECONDS):
+        self.max_games = max_games
+        self.ttl = ttl
+        self._games: "OrderedDict[str, GameState]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, game_id: str) -> Optional[GameState]:
+        with self._lock:
+            state = self._games.get(game_id)
+            if state is None:
+                return None
+            if time.time() - state.start_time > self.ttl:
+                del self._games[game_id]
+                return None
+            self._games.move_to_end(game_id)
+            return state
+
+    def update(self, game_id: str, fn: Callable[[GameState], T]) -> Optional[T]:
+        """Changes a game in place with ``fn``, which returns what it needs of the
+        state, so that concurrent changes of the same game don't overwrite each
+        other. Returns None if there is no such game.
+        """
+        with self._lock:
+            state = self._games.get(game_id)
+            if state is None:
+                return None
+            if time.time() - state.start_time > self.ttl:
+                del self._games[game_id]
+                return None
+            self._games.move_to_end(game_id)
+            return fn(state)
+
+    def put(self, state: GameState):
+        with self._lock:
+            self._games[state.game_id] = state
+            self._games.move_to_end(state.game_id)
+            while len(self._games) > self.max_games:
+                self._games.popitem(last=False)
+
+    def delete(self, game_id: str):
+        with self._lock:
+            self._games.pop(game_id, None)
+
+
+class SQLiteStateBackend:
+    """Keeps games in a SQLite file so several workers can share them."""
+
+    shared = True
+
+    def __init__(self, path: str, ttl: int = GAME_TTL_SECONDS):
+        self.path = path
+        self.ttl = ttl
+        self._local = threading.local()
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS games ("
+                "game_id TEXT PRIMARY KEY, state TEXT NOT NULL, start_time REAL NOT NULL)"
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, game_id: str) -> Optional[GameState]:
+        row = self._connection().execute(
+            "SELECT state, start_time FROM games WHERE game_id = ?", (game_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        if time.time() - row[1] > self.ttl:
+            self.delete(game_id)
+            return None
+        return GameState.from_dict(json.loads(row[0]))
+
+    def update(self, game_id: str, fn: Callable[[GameState], T]) -> Optional[T]:
+        """Changes a game with ``fn`` in a write transaction, like `MemoryStateBackend.update`.
+
+        The transaction locks the database for writing before the game is
+        read, so the other workers wait instead of overwriting the change.
+        """
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT state, start_time FROM games WHERE game_id = ?", (game_id,)).fetchone()
+            if row is None or time.time() - row[1] > self.ttl:
+                conn.rollback()
+                return None
+            state = GameState.from_dict(json.loads(row[0]))
+            result = fn(state)
+            conn.execute("UPDATE games SET state = ? WHERE game_id = ?", (json.dumps(state.to_dict()), game_id))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return result
+
+    def put(self, state: GameState):
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO games (game_id, state, start_time) VALUES (?, ?, ?)",
+                (state.game_id, json.dumps(state.to_dict()), state.start_time),
+            )
+            conn.execute("DELETE FROM games WHERE start_time < ?", (time.time() - self.ttl,))
+
+    def delete(self, game_id: str):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM games WHERE game_id = ?", (game_id,))
+
+
+_backend = None
+
+
+def get_state_backend():
+    """Returns the configured game state backend.
+
+    ``GAME_STATE_BACKEND=sqlite`` stores games in ``GAME_STATE_DB`` (default
+    ``games.db``), anything else keeps them in memory.
+    """
+    global _backend
+    if _backend is None:
+        if os.getenv("GAME_STATE_BACKEND", "memory") == "sqlite":
+            _backend = SQLiteStateBackend(os.getenv("GAME_STATE_DB", "games.db"))
+        else:
+            _backend = MemoryStateBackend()
+    return _backend
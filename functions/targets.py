@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from functions.geo import EARTH_RADIUS_M
+from functions.state import GAME_DURATION_SECONDS
+
+# how close, in metres, a player has to be to the target to find it
+VERIFY_RADIUS_M = float(os.getenv("VERIFY_RADIUS_M", "50"))
+# how old, in seconds, an entry may get before it is reloaded from a state
+# backend that other workers change too
+TARGET_REFRESH_SECONDS = float(os.getenv("TARGET_REFRESH_SECONDS", "5"))
+
+
+def haversine_np(lat1, lng1, lat2, lng2) -> np.ndarray:
+    """Vectorized great circle distance in metres."""
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+
+class TargetIndex:
+    """The current target of every active game.
+
+    Every ping is checked against its own game's target, so a dict lookup
+    finds it and the distances of a whole batch are computed in one
+    vectorized pass. Games that are abandoned instead of ended are dropped
+    once they are older than ``max_age`` seconds, by a sweep that runs at
+    most every ``sweep_interval`` seconds.
+
+    The index only sees the games of its own process. With a state backend
+    shared by several workers, `stale` tells which entries are due to be
+    reloaded from the backend.
+    """
+
+    def __init__(self, max_age: float = GAME_DURATION_SECONDS, sweep_interval: float = 60.0):
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+        # game id -> (lat, lng, start time of the game, when the entry was set)
+        self._targets: Dict[str, Tuple[float, float, float, float]] = {}
+        self._swept = time.time()
+        self._lock = threading.Lock()
+
+    def __contains__(self, game_id: str) -> bool:
+        return game_id in self._targets
+
+    def __len__(self) -> int:
+        return len(self._targets)
+
+    def update(self, game_id: str, lat: float, lng: float, started: Optional[float] = None):
+        """Sets the target of a game that started at ``started``, now if not given."""
+        now = time.time()
+        with self._lock:
+            self._targets[game_id] = (lat, lng, now if started is None else started, now)
+        self.sweep()
+
+    def remove(self, game_id: str):
+        with self._lock:
+            self._targets.pop(game_id, None)
+
+    def stale(self, game_ids: Iterable[str], max_age: float) -> List[str]:
+        """Returns the games that have no entry or one set over ``max_age`` seconds ago."""
+        now = time.time()
+        with self._lock:
+            return [
+                game_id for game_id in game_ids
+                if game_id not in self._targets or now - self._targets[game_id][3] > max_age
+            ]
+
+    def sweep(self, force: bool = False):
+        """Drops the targets of games that are over by now."""
+        now = time.time()
+        if not force and now - self._swept < self.sweep_interval:
+            return
+        self._swept = now
+        with self._lock:
+            for game_id in [game_id for game_id, (_, _, started, _) in self._targets.items()
+                            if now - started > self.max_age]:
+                del self._targets[game_id]
+
+    def check(self, pings: Sequence[Tuple[str, float, float]], radius: float = VERIFY_RADIUS_M) -> np.ndarray:
+        """Checks many (game_id, lat, lng) pings against the targets in one pass.
+
+        Returns a boolean array that is True where a ping is within
+        ``radius`` metres of the current target of its own game.
+        """
+        ping_index, target_lat, target_lng = [], [], []
+        with self._lock:
+            for index, (game_id, _, _) in enumerate(pings):
+                target = self._targets.get(game_id)
+                if target is not None:
+                    ping_index.append(index)
+                    target_lat.append(target[0])
+                    target_lng.append(target[1])
+
+        found = np.zeros(len(pings), dtype=bool)
+        if not ping_index:
+            return found
+        ping_index = np.asarray(ping_index)
+        coordinates = np.asarray([(lat, lng) for _, lat, lng in pings], dtype=float)[ping_index]
+        distances = haversine_np(coordinates[:, 0], coordinates[:, 1], np.asarray(target_lat), np.asarray(target_lng))
+        found[ping_index[distances <= radius]] = True
+        return found
+
+
+targets = TargetIndex()
@@ -0,0 +1,284 @@
+"""Offline tile packs of the places in a region.
+
+A tile pack is a single file that is crawled once per city with
+
+    python -m functions.tiles build --bounds south,west,north,east --out city.tiles
+
+and memory-mapped at runtime to answer nearby searches without calling the
+Places API. The file holds a JSON header, a fixed-width record per place
+sorted by geohash and a blob with the names, place ids and type lists.
+
+The crawl can't page past the first results of a search, so the searches
+that returned a full page are kept in the header. Places may be missing
+around them, and searches overlapping them are left to the live API.
+"""
+import argparse
+import json
+import math
+import os
+import struct
+from logging import getLogger
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from functions.geo import EARTH_RADIUS_M, geohash
+
+logger = getLogger(__name__)
+
+MAGIC = b"AMTILES3"
+
+# the most results a nearby search returns without paging
+PAGE_SIZE = 20
+
+# the precision of the geohash index, cells are about 1.2 km x 0.6 km
+INDEX_PRECISION = 6
+
+RECORD_DTYPE = np.dtype([
+    ("geohash", "S8"),
+    ("lat", "<f8"),
+    ("lng", "<f8"),
+    # indices into the header's type names, as little endian u2 in the blob
+    ("types_offset", "<u4"),
+    ("types_length", "<u2"),
+    # NaN if the place has no rating
+    ("rating", "<f4"),
+    ("user_ratings_total", "<u4"),
+    ("name_offset", "<u4"),
+    ("name_length", "<u2"),
+    ("place_id_offset", "<u4"),
+    ("place_id_length", "<u2"),
+])
+
+
+def write_tile_pack(path: str, places: Iterable[Dict], bounds: Tuple[float, float, float, float],
+                    truncated: Iterable[Tuple[float, float, float]] = ()):
+    """Writes places in the Places API result format to a tile pack.
+
+    Args:
+        path (str): Where to write the pack.
+        places (Iterable[Dict]): Places with "place_id", "name", "types",
+            "geometry" and, if they are rated, "rating" and "user_ratings_total".
+        bounds (Tuple[float, float, float, float]): The (south, west, north, east) the pack covers.
+        truncated (Iterable[Tuple[float, float, float]]): The (lat, lng, radius)
+            of the crawl's searches that returned a full page.
+
+    Raises:
+        ValueError: The places have more type names than a pack can index.
+    """
+    unique = {place["place_id"]: place for place in places}
+    types = sorted({t for place in unique.values() for t in place.get("types", [])})
+    if len(types) > 1 << 16:
+        raise ValueError(f"The places have {len(types)} types, a tile pack holds at most {1 << 16}")
+    type_index = {t: i for i, t in enumerate(types)}
+
+    records = np.zeros(len(unique), dtype=RECORD_DTYPE)
+    blob = bytearray()
+    for i, place in enumerate(unique.values()):
+        location = place["geometry"]["location"]
+        name = place.get("name", "").encode()[:65535]
+        place_id = place["place_id"].encode()
+        place_types = np.asarray([type_index[t] for t in place.get("types", [])], dtype="<u2").tobytes()
+        records[i] = (
+            geohash(location["lat"], location["lng"], 8).encode(),
+            location["lat"],
+            location["lng"],
+            len(blob) + len(name) + len(place_id),
+            len(place_types) // 2,
+            place["rating"] if place.get("rating") is not None else np.nan,
+            place.get("user_ratings_total") or 0,
+            len(blob),
+            len(name),
+            len(blob) + len(name),
+            len(place_id),
+        )
+        blob += name + place_id + place_types
+    records.sort(order="geohash")
+
+    header = json.dumps({
+        "count": len(records), "types": types, "bounds": list(bounds), "truncated": [list(t) for t in truncated],
+    }).encode()
+    # keep the records 8 byte aligned
+    header += b" " * (-(len(MAGIC) + 8 + len(header)) % 8)
+    with open(path, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        f.write(records.tobytes())
+        f.write(bytes(blob))
+
+
+class TilePack:
+    """A memory-mapped tile pack that answers nearby searches locally."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a tile pack")
+            header_length = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(header_length))
+        offset = len(MAGIC) + 8 + header_length
+        self.types: List[str] = header["types"]
+        self.bounds: Tuple[float, float, float, float] = tuple(header["bounds"])
+        self.truncated = np.asarray(header.get("truncated", []), dtype=float).reshape(-1, 3)
+        self.records = np.memmap(path, dtype=RECORD_DTYPE, mode="r", offset=offset, shape=(header["count"],))
+        self.blob = np.memmap(path, dtype=np.uint8, mode="r", offset=offset + self.records.nbytes)
+        self._cells = self.records["geohash"].astype(f"S{INDEX_PRECISION}")
+
+    def covers(self, lat: float, lng: float, radius: float = 0) -> bool:
+        south, west, north, east = self.bounds
+        dlat = math.degrees(radius / EARTH_RADIUS_M)
+        dlng = dlat / max(math.cos(math.radians(lat)), 1e-6)
+        if not (south <= lat - dlat and lat + dlat <= north and west <= lng - dlng and lng + dlng <= east):
+            return False
+        # the pack may lack places where the crawl got a full page
+        if len(self.truncated):
+            lats, lngs, radii = self.truncated.T
+            phi1, phi2 = np.radians(lat), np.radians(lats)
+            a = np.sin((phi2 - phi1) / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(np.radians(lngs - lng) / 2) ** 2
+            if (2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a)) < radius + radii).any():
+                return False
+        return True
+
+    def _candidates(self, lat: float, lng: float, radius: float) -> np.ndarray:
+        # the geohash cells overlapping the search circle, found by sampling
+        # its bounding box more densely than the cell size
+        dlat = math.degrees(radius / EARTH_RADIUS_M)
+        dlng = dlat / max(math.cos(math.radians(lat)), 1e-6)
+        cell_lat, cell_lng = 180 / 2 ** 15, 360 / 2 ** 15
+        cells = {
+            geohash(lat + y, lng + x, INDEX_PRECISION).encode()
+            for y in np.append(np.arange(-dlat, dlat, cell_lat / 2), dlat)
+            for x in np.append(np.arange(-dlng, dlng, cell_lng / 2), dlng)
+        }
+        ranges = [
+            np.arange(np.searchsorted(self._cells, cell, "left"), np.searchsorted(self._cells, cell, "right"))
+            for cell in cells
+        ]
+        return np.concatenate(ranges) if ranges else np.array([], dtype=int)
+
+    def _text(self, offset: int, length: int) -> str:
+        return bytes(self.blob[offset:offset + length]).decode()
+
+    def _types(self, offset: int, length: int) -> List[str]:
+        indices = np.frombuffer(bytes(self.blob[offset:offset + 2 * length]), dtype="<u2")
+        return [self.types[i] for i in indices]
+
+    def nearby(self, lat: float, lng: float, radius: float, keyword: Optional[str] = None) -> List[Dict]:
+        """Returns the places within ``radius`` metres, most rated first.
+
+        The places are in the Places API result format, and the number of
+        ratings stands in for the prominence the API ranks them by, with the
+        nearer of equally rated places first. A keyword has to appear in the
+        name or the types of a place.
+        """
+        index = self._candidates(lat, lng, radius)
+        records = self.records[index]
+        phi1, phi2 = np.radians(lat), np.radians(records["lat"])
+        a = np.sin((phi2 - phi1) / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(np.radians(records["lng"] - lng) / 2) ** 2
+        distances = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
+
+        inside = np.flatnonzero(distances <= radius)
+        order = inside[np.lexsort((distances[inside], -records["user_ratings_total"][inside].astype(np.int64)))]
+
+        results = []
+        for i in order:
+            record = records[i]
+            types = self._types(int(record["types_offset"]), int(record["types_length"]))
+            name = self._text(int(record["name_offset"]), int(record["name_length"]))
+            if keyword and not _matches(keyword, name, types):
+                continue
+            place = {
+                "name": name,
+                "place_id": self._text(int(record["place_id_offset"]), int(record["place_id_length"])),
+                "types": types,
+                "geometry": {"location": {"lat": float(record["lat"]), "lng": float(record["lng"])}},
+            }
+            if not np.isnan(record["rating"]):
+                place["rating"] = round(float(record["rating"]), 1)
+                place["user_ratings_total"] = int(record["user_ratings_total"])
+            results.append(place)
+        return results
+
+
+def _matches(keyword: str, name: str, types: List[str]) -> bool:
+    words = keyword.lower().replace("_", " ").split()
+    text = " ".join([name.lower()] + [t.replace("_", " ") for t in types])
+    return all(word in text for word in words)
+
+
+_packs: Optional[List[TilePack]] = None
+
+
+def get_tile_packs() -> List[TilePack]:
+    """Returns the packs listed in ``TILE_PACKS`` (comma separated paths)."""
+    global _packs
+    if _packs is None:
+        paths = [path for path in os.getenv("TILE_PACKS", "").split(",") if path]
+        _packs = [TilePack(path) for path in paths]
+    return _packs
+
+
+def find_nearby(lat: float, lng: float, radius: float, keyword: Optional[str] = None) -> Optional[List[Dict]]:
+    """Answers a nearby search from the tile packs.
+
+    Returns None on a miss, i.e. when no pack covers the search circle, the
+    crawl may have missed places in it or the pack has no matching place,
+    so that the caller asks the live API.
+    """
+    for pack in get_tile_packs():
+        if pack.covers(lat, lng, radius):
+            results = pack.nearby(lat, lng, radius, keyword)
+            return results or None
+    return None
+
+
+def crawl(api_key: str, bounds: Tuple[float, float, float, float], spacing: float,
+          keywords: List[str]) -> Tuple[List[Dict], List[Tuple[float, float, float]]]:
+    """Collects the places in a region with nearby searches on a grid.
+
+    Returns the places and the (lat, lng, radius) of the searches that
+    returned a full page, which may have missed some.
+    """
+    from functions.maps import get_maps_client
+
+    maps = get_maps_client(api_key)
+    south, west, north, east = bounds
+    step_lat = math.degrees(spacing / EARTH_RADIUS_M)
+    step_lng = step_lat / max(math.cos(math.radians((south + north) / 2)), 1e-6)
+    # the circles of neighbouring grid points overlap so nothing is missed
+    radius = int(spacing * 0.75)
+
+    places, truncated = [], []
+    for lat in np.arange(south, north + step_lat, step_lat):
+        for lng in np.arange(west, east + step_lng, step_lng):
+            for keyword in [None] + keywords:
+                results = maps.nearby_search(f"{lat},{lng}", radius, keyword)
+                places.extend(results)
+                # a keyword search only covers the places it matches
+                if keyword is None and len(results) >= PAGE_SIZE:
+                    truncated.append((float(lat), float(lng), float(radius)))
+    return places, truncated
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build an offline tile pack of the places in a region.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build = subparsers.add_parser("build")
+    build.add_argument("--bounds", required=True, help="south,west,north,east")
+    build.add_argument("--out", required=True)
+    build.add_argument("--spacing", type=float, default=300, help="distance between searches in metres")
+    build.add_argument("--keywords", default="", help="comma separated keywords to crawl as well")
+    args = parser.parse_args(argv)
+
+    bounds = tuple(float(x) for x in args.bounds.split(","))
+    keywords = [keyword for keyword in args.keywords.split(",") if keyword]
+    places, truncated = crawl(os.getenv("MAPS_API_KEY"), bounds, args.spacing, keywords)
+    write_tile_pack(args.out, places, bounds, truncated)
+    print(f"Wrote {len({place['place_id'] for place in places})} places to {args.out}, "
+          f"{len(truncated)} searches returned a full page")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from typing import Callable, Deque, Dict, List, Optional, Tuple, Union
+
+from functions.geo import geohash, parse_lat_lng
+from functions.llm import SemanticCache
+from functions.metrics import count
+from functions.scheduler import BACKGROUND, scheduler, with_priority
+
+logger = getLogger(__name__)
+
+# the pool is off unless WARM_POOL=1
+WARM_POOL = os.getenv("WARM_POOL", "0") == "1"
+
+# the geohash precision of the pooled areas, cells are about 1.2 km x 0.6 km
+CELL_PRECISION = int(os.getenv("WARM_POOL_PRECISION", "6"))
+
+# the most games kept ready in total and per area and interests
+MAX_GAMES = int(os.getenv("WARM_POOL_SIZE", "50"))
+MAX_GAMES_PER_KEY = int(os.getenv("WARM_POOL_PER_KEY", "3"))
+
+# seconds after which the demand of a key has halved
+DEMAND_HALF_LIFE = float(os.getenv("WARM_POOL_HALF_LIFE", "1800"))
+
+# keys with less demand than this get no games, and lose the ones they have
+MIN_DEMAND = float(os.getenv("WARM_POOL_MIN_DEMAND", "2"))
+
+# the longest a pooled game is kept, for keys with MIN_DEMAND. busier keys
+# keep their games proportionally longer, up to four times as long
+GAME_TTL = float(os.getenv("WARM_POOL_TTL", "900"))
+
+# seconds between two refills
+REFILL_INTERVAL = float(os.getenv("WARM_POOL_INTERVAL", "30"))
+
+Key = Tuple[str, str]
+
+
+def interests_key(interests: str) -> str:
+    """Reduces interests to their words, so "parks and museums" matches "museums, parks"."""
+    return " ".join(sorted(SemanticCache.tokens(interests)))
+
+
+class Demand:
+    """The exponentially decayed number of games started for a key."""
+
+    __slots__ = ("score", "updated", "location", "interests", "floor")
+
+    def __init__(self, location: str, interests: str, floor: float = 0.0):
+        self.score = 0.0
+        self.updated = time.time()
+        self.location = location
+        self.interests = interests
+        # the demand never decays below this, used to keep seeds warm
+        self.floor = floor
+
+    def value(self, now: float) -> float:
+        return max(self.floor, self.score * 0.5 ** ((now - self.updated) / DEMAND_HALF_LIFE))
+
+    def add(self, now: float):
+        self.score = self.value(now) + 1
+        self.updated = now
+
+
+class WarmPool:
+    """Keeps fully built games ready for the areas and interests that are asked for most.
+
+    Every started game counts towards the demand of its (geohash cell,
+    interests) key. A background worker builds games for the keys in
+    order of demand, and drops the games of keys that have gone cold.
+    Pooled games of busier keys are kept longer. `claim` hands a pooled
+    game out at most once.
+
+    Args:
+        build (Callable): Builds a game for a location and interests, and
+            returns a message string if it can't.
+        seeds (List[Tuple[str, str]]): (location, interests) to keep warm
+            before any demand has been seen.
+    """
+
+    def __init__(self, build: Callable[[str, str], Union[str, Dict]],
+                 seeds: Optional[List[Tuple[str, str]]] = None, workers: int = 2):
+        self.build = build
+        self._demand: Dict[Key, Demand] = {}
+        self._games: Dict[Key, Deque[Tuple[float, Dict]]] = {}
+        self._building: Dict[Key, int] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="warm-pool")
+        for location, interests in seeds or []:
+            self._demand[self.key(location, interests)] = Demand(location, interests, floor=MIN_DEMAND)
+
+    @staticmethod
+    def key(location: str, interests: str) -> Key:
+        lat, lng = parse_lat_lng(location)
+        return geohash(lat, lng, CELL_PRECISION), interests_key(interests)
+
+    def record(self, location: str, interests: str):
+        """Counts a started game towards the demand of its key."""
+        key = self.key(location, interests)
+        with self._lock:
+            demand = self._demand.get(key)
+            if demand is None:
+                demand = self._demand[key] = Demand(location, interests)
+            demand.add(time.time())
+            # the most recent player's location is where the next games are built
+            demand.location, demand.interests = location, interests
+
+    def claim(self, location: str, interests: str) -> Optional[Dict]:
+        """Takes a ready game for the location and interests, None if there is none."""
+        key = self.key(location, interests)
+        now = time.time()
+        with self._lock:
+            games = self._games.get(key)
+            while games:
+                expires, game = games.popleft()
+                if expires > now:
+                    count("warm_pool", result="hit")
+                    return game
+        count("warm_pool", result="miss")
+        return None
+
+    def _ttl(self, demand: float) -> float:
+        return GAME_TTL * min(4.0, max(1.0, demand / MIN_DEMAND))
+
+    def _wanted(self, now: float) -> List[Tuple[Key, int]]:
+        """Returns how many more games every key should get, the busiest keys first."""
+        ranked = sorted(
+            ((key, demand.value(now)) for key, demand in self._demand.items()),
+            key=lambda item: -item[1],
+        )
+        wanted = []
+        room = MAX_GAMES
+        for key, demand in ranked:
+            if demand < MIN_DEMAND or room <= 0:
+                break
+            target = min(MAX_GAMES_PER_KEY, room, max(1, math.ceil(demand / MIN_DEMAND)))
+            have = len(self._games.get(key, ())) + self._building.get(key, 0)
+            room -= target
+            if have < target:
+                wanted.append((key, target - have))
+        return wanted
+
+    def _evict(self, now: float):
+        for key in list(self._games):
+            demand = self._demand.get(key)
+            games = self._games[key]
+            if demand is None or demand.value(now) < MIN_DEMAND:
+                # the key has gone cold
+                del self._games[key]
+                continue
+            while games and games[0][0] <= now:
+                games.popleft()
+        for key in [key for key, demand in self._demand.items() if demand.value(now) < 0.01]:
+            del self._demand[key]
+
+    def refill(self):
+        """Drops expired and cold games and starts building the missing ones."""
+        now = time.time()
+        builds = []
+        with self._lock:
+            self._evict(now)
+            # games are only built with quota to spare
+            if scheduler.congested("maps") or scheduler.congested("openai"):
+                count("degraded", stage="warm_pool")
+                return
+            for key, missing in self._wanted(now):
+                self._building[key] = self._building.get(key, 0) + missing
+                demand = self._demand[key]
+                builds += [(key, demand.location, demand.interests)] * missing
+        for build in builds:
+            self._executor.submit(with_priority(BACKGROUND, self._build), *build)
+
+    def _build(self, key: Key, location: str, interests: str):
+        try:
+            game = self.build(location, interests)
+        except Exception:
+            logger.warning("Building a pooled game for %s failed", key, exc_info=True)
+            game = None
+        with self._lock:
+            self._building[key] -= 1
+            if not self._building[key]:
+                del self._building[key]
+            if isinstance(game, dict):
+                demand = self._demand.get(key)
+                ttl = self._ttl(demand.value(time.time()) if demand else MIN_DEMAND)
+                self._games.setdefault(key, deque()).append((time.time() + ttl, game))
+                count("warm_pool_builds", result="ok")
+            else:
+                count("warm_pool_builds", result="failed")
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refill()
+            except Exception:
+                logger.warning("Refilling the warm pool failed", exc_info=True)
+            self._stop.wait(REFILL_INTERVAL)
+
+    def start(self):
+        """Starts the background worker."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="warm-pool", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self) -> Dict:
+        now = time.time()
+        with self._lock:
+            return {
+                "games": sum(len(games) for games in self._games.values()),
+                "building": sum(self._building.values()),
+                "keys": {
+                    f"{cell}/{interests}": {
+                        "demand": round(demand.value(now), 2),
+                        "games": len(self._games.get((cell, interests), ())),
+                    }
+                    for (cell, interests), demand in self._demand.items()
+                },
+            }
+
+
+def parse_seeds(value: str) -> List[Tuple[str, str]]:
+    """Parses ``WARM_POOL_SEEDS``, e.g. "52.52,13.40:museums and parks;48.85,2.35:cafes"."""
+    seeds = []
+    for seed in value.split(";"):
+        if seed.strip():
+            location, interests = seed.split(":", 1)
+            seeds.append((location.strip(), interests.strip()))
+    return seeds
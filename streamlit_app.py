@@ -2,33 +2,69 @@ import streamlit as st
 from streamlit_geolocation import streamlit_geolocation
 import requests
 import base64
+import json
 
 # Function to send concatenated input and location to the API
-def send_concatenated_input_to_api(concatenated_input):
+def send_concatenated_input_to_api(concatenated_input, on_event=None, location=None):
+    """Sends the input to the API and returns its answer.
+
+    When ``on_event`` is given the answer is streamed from /ask/stream and
+    ``on_event(event, data)`` is called for every event as it arrives. The
+    ``location`` is sent apart from the text too, so that the server can
+    answer without asking the agent.
+    """
     api_url = "https://67db-106-51-78-137.ngrok-free.app/ask/"  # Replace with your API endpoint
     headers = {"Content-Type": "application/json"}
-    payload = {"data": concatenated_input}
+    payload = {"data": concatenated_input, "session_token": st.session_state.get("session_token")}
+    if location and location.get("latitude") is not None:
+        payload["location"] = f"{location['latitude']},{location['longitude']}"
+
+    if on_event is not None:
+        return stream_from_api(api_url + "stream", payload, on_event)
 
     try:
         response = requests.post(api_url, json=payload, headers=headers)
         response.raise_for_status()
+        # keep talking to the same agent session on the next request
+        st.session_state["session_token"] = response.headers.get("X-Session-Token")
         return response.json()  # Assuming the API returns a JSON response with image and voice URLs
     except requests.exceptions.HTTPError as err:
         return {"error": str(err)}
 
-# Function to send base64-encoded image and location to the API
-def send_base64_image_and_location_to_api(image, location):
-    api_url = "https://67db-106-51-78-137.ngrok-free.app/ask/"  # Replace with your API endpoint
-    image_base64 = base64.b64encode(image).decode('utf-8')
-    payload = {
-        "image": image_base64,
-        "location": f"my current location is {location}"
+# Function to read the Server-Sent Events of a streamed answer
+def stream_from_api(api_url, payload, on_event):
+    try:
+        with requests.post(api_url, json=payload, stream=True) as response:
+            response.raise_for_status()
+            st.session_state["session_token"] = response.headers.get("X-Session-Token")
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event: "):
+                    event = line[len("event: "):]
+                elif line.startswith("data: "):
+                    data = json.loads(line[len("data: "):])
+                    if event == "result":
+                        return data if isinstance(data, dict) else {"response": data}
+                    if event == "error":
+                        return data
+                    on_event(event, data)
+        return {"error": "The stream ended without an answer"}
+    except requests.exceptions.HTTPError as err:
+        return {"error": str(err)}
+
+# Function to send an image and the location to the API as a multipart upload
+def send_image_and_location_to_api(image, location):
+    api_url = "https://67db-106-51-78-137.ngrok-free.app/verify/image"  # Replace with your API endpoint
+    data = {
+        "location": f"{location['latitude']},{location['longitude']}",
+        "session_token": st.session_state.get("session_token") or "",
     }
 
     try:
-        response = requests.post(api_url, json=payload)
+        response = requests.post(api_url, files={"image": ("image.jpg", image)}, data=data)
         response.raise_for_status()
-        return response.json()  # Assuming the API returns a JSON response with image and voice URLs
+        st.session_state["session_token"] = response.headers.get("X-Session-Token")
+        return response.json()
     except requests.exceptions.HTTPError as err:
         return {"error": str(err)}
 
@@ -46,6 +82,7 @@ st.markdown("### Enter your input and use the buttons below to submit text or ca
 
 # Input field
 user_input = st.text_input("Your Input:", placeholder="Type something...")
+stream_answers = st.checkbox("Stream answers", value=True)
 
 # Function to get the user's location
 def get_location():
@@ -63,7 +100,22 @@ if st.button("Submit Text"):
         location = get_location()
         if location:
             concatenated_input = f"{user_input} and my current location is {location}"
-            result = send_concatenated_input_to_api(concatenated_input)
+            if stream_answers:
+                status = st.empty()
+                answer = st.empty()
+                streamed_text = []
+
+                def show_event(event, data):
+                    if event == "progress":
+                        status.info(f"{data['stage'].capitalize()}...")
+                    elif event == "token":
+                        streamed_text.append(data["text"])
+                        answer.markdown("".join(streamed_text))
+
+                result = send_concatenated_input_to_api(concatenated_input, on_event=show_event, location=location)
+                status.empty()
+            else:
+                result = send_concatenated_input_to_api(concatenated_input, location=location)
 
             if "error" in result:
                 st.error(f"Error: {result['error']}")
@@ -86,7 +138,7 @@ if st.button("Capture Image and Send"):
         location = get_location()
         if location:
             image_bytes = uploaded_image.read()
-            result = send_base64_image_and_location_to_api(image_bytes, location)
+            result = send_image_and_location_to_api(image_bytes, location)
 
             if "error" in result:
                 st.error(f"Error: {result['error']}")
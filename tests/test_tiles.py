@@ -0,0 +1,112 @@
+"""Checks that tile packs answer nearby searches like a scan of all places would."""
+import json
+import os
+import random
+
+import pytest
+
+from functions.geo import haversine
+from functions.tiles import TilePack, write_tile_pack
+
+FIXTURES = os.path.join(os.path.dirname(__file__), os.pardir, "bench", "fixtures", "berlin.json")
+BOUNDS = (52.45, 13.30, 52.59, 13.51)
+
+
+def synthetic_places(count: int = 2000, seed: int = 0):
+    rng = random.Random(seed)
+    kinds = ["museum", "cafe", "park", "church", "art_gallery"]
+    places = []
+    for i in range(count):
+        kind = rng.choice(kinds)
+        place = {
+            "place_id": f"place{i}",
+            "name": f"{kind.title()} {i}",
+            "types": [kind, "point_of_interest"],
+            "geometry": {"location": {"lat": rng.uniform(52.46, 52.58), "lng": rng.uniform(13.31, 13.50)}},
+        }
+        if rng.random() < 0.8:
+            place["rating"] = round(rng.uniform(1, 5), 1)
+            place["user_ratings_total"] = rng.randrange(1, 5000)
+        places.append(place)
+    return places
+
+
+def brute_force(places, lat, lng, radius, keyword=None):
+    found = []
+    for place in places:
+        location = place["geometry"]["location"]
+        distance = haversine(lat, lng, location["lat"], location["lng"])
+        text = " ".join([place["name"].lower()] + place["types"])
+        if distance <= radius and (keyword is None or keyword in text):
+            found.append((-place.get("user_ratings_total", 0), distance, place["place_id"]))
+    return [place_id for _, _, place_id in sorted(found)]
+
+
+@pytest.fixture(scope="module")
+def places():
+    with open(FIXTURES) as f:
+        return synthetic_places() + json.load(f)["places"]
+
+
+@pytest.fixture(scope="module")
+def pack(places, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("tiles") / "berlin.tiles")
+    write_tile_pack(path, places, BOUNDS)
+    return TilePack(path)
+
+
+@pytest.mark.parametrize("radius", [50, 300, 1000, 2500])
+def test_nearby_matches_brute_force(pack, places, radius):
+    rng = random.Random(radius)
+    for _ in range(20):
+        lat, lng = rng.uniform(52.48, 52.56), rng.uniform(13.34, 13.47)
+        results = pack.nearby(lat, lng, radius)
+        assert [place["place_id"] for place in results] == brute_force(places, lat, lng, radius)
+
+
+def test_keyword(pack, places):
+    results = pack.nearby(52.52, 13.405, 1500, "museum")
+    assert results
+    assert [place["place_id"] for place in results] == brute_force(places, 52.52, 13.405, 1500, "museum")
+
+
+def test_round_trip(pack, places):
+    by_id = {place["place_id"]: place for place in places}
+    for result in pack.nearby(52.52, 13.405, 3000):
+        place = by_id[result["place_id"]]
+        assert result["name"] == place["name"]
+        assert sorted(result["types"]) == sorted(place["types"])
+        assert result["geometry"]["location"] == pytest.approx(place["geometry"]["location"])
+        assert result.get("rating") == place.get("rating")
+        assert result.get("user_ratings_total") == place.get("user_ratings_total")
+
+
+def test_many_types(tmp_path):
+    types = [f"type_{i:03d}" for i in range(100)] + ["zoo"]
+    places = [
+        {
+            "place_id": f"place{i}",
+            "name": f"Place {i}",
+            "types": [t, "point_of_interest"],
+            "geometry": {"location": {"lat": 52.52 + i * 1e-5, "lng": 13.405}},
+        }
+        for i, t in enumerate(types)
+    ]
+    path = str(tmp_path / "types.tiles")
+    write_tile_pack(path, places, BOUNDS)
+    pack = TilePack(path)
+
+    results = {place["place_id"]: place["types"] for place in pack.nearby(52.52, 13.405, 500)}
+    assert len(results) == len(places)
+    for place in places:
+        assert sorted(results[place["place_id"]]) == sorted(place["types"])
+    assert [place["place_id"] for place in pack.nearby(52.52, 13.405, 500, "zoo")] == [f"place{len(types) - 1}"]
+
+
+def test_truncated_searches_are_not_covered(tmp_path, places):
+    path = str(tmp_path / "truncated.tiles")
+    write_tile_pack(path, places, BOUNDS, truncated=[(52.52, 13.405, 500)])
+    pack = TilePack(path)
+    assert not pack.covers(52.52, 13.405, 100)
+    assert not pack.covers(52.525, 13.405, 100)
+    assert pack.covers(52.50, 13.35, 100)